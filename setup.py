@@ -16,9 +16,10 @@ setuptools.setup(
     license=zget.__license__,
     packages=setuptools.find_packages(),
     entry_points={"console_scripts": ["zenodo_get = zenodo_get.zget:zenodo_get"]},
-    python_requires=">=3.8",
+    python_requires=">=3.9",
     setup_requires=[],
-    install_requires=["requests", "wget"],
+    install_requires=["requests"],
+    extras_require={"async": ["aiohttp"]},
     keywords="zenodo download",
     classifiers=[
         "Development Status :: 4 - Beta",
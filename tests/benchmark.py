@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""Benchmark zenodo_get against the local mock server (tests/mock_zenodo.py).
+
+Every scenario is a synthetic record, which zenodo_get downloads into an
+empty temporary directory, in a child process of this script. For each run
+the wall time, throughput, CPU time (user and system) and peak RSS of the
+child are measured, and all results are written as JSON:
+
+    python3 tests/benchmark.py -s small -s large -o results.json
+    python3 tests/benchmark.py --files 100x50M -- -j 8 --segments 4
+
+The server can inject faults (see tests/mock_zenodo.py), on a schedule
+which only depends on --seed; the results then also show how many bytes
+were sent again, and --attempts re-runs zenodo_get after a failure, to
+measure the time to completion including the resume of partial files:
+
+    python3 tests/benchmark.py -f 20x50M --resets 0.3 --errors 0.2 \\
+        --attempts 5 -- -R 5 -p 0.1
+
+Arguments after '--' are passed to zenodo_get. The zenodo_get of this source
+tree is benchmarked, not an installed one.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+import mock_zenodo
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = {
+    "small": "10000x10k",
+    "medium": "100x10M",
+    "large": "5x2G",
+    "mixed": "1000x10k+20x10M+1x1G",
+}
+
+
+def version():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def invoke(server, record, args, workdir):
+    """Run zenodo_get once; return its exit code and resource usage."""
+    env = dict(
+        os.environ,
+        ZENODO_URL=server.url,
+        DOI_RESOLVER=server.url + "/doi/",
+        PYTHONPATH=os.pathsep.join([ROOT] + sys.path[1:]),
+    )
+    outdir = os.path.join(workdir, "out")
+    command = [sys.executable, "-m", "zenodo_get", "--no-cache", "-o", outdir]
+    command += args + [record]
+    with open(os.path.join(workdir, "zenodo_get.log"), "ab") as log:
+        start = time.monotonic()
+        child = subprocess.Popen(
+            command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT
+        )
+        _, status, usage = os.wait4(child.pid, 0)
+        wall = time.monotonic() - start
+    return os.waitstatus_to_exitcode(status), wall, usage
+
+
+def run(server, recordID, args, workdir, doi=False, attempts=1):
+    """Download the record with zenodo_get into an empty directory; return
+    the measurements.
+
+    If zenodo_get fails, it is run again in the same directory, up to
+    attempts times, so that the existing files are checked and the partial
+    ones resumed. The times and CPU times are summed over the attempts.
+    """
+    shutil.rmtree(os.path.join(workdir, "out"), ignore_errors=True)
+    open(os.path.join(workdir, "zenodo_get.log"), "wb").close()
+    server.reset_stats()
+    if server.faults is not None:
+        server.faults.reset()
+    record = f"10.1234/bench.{recordID}" if doi else str(recordID)
+    wall = user = system = max_rss = 0
+    for attempt in range(attempts):
+        returncode, seconds, usage = invoke(server, record, args, workdir)
+        wall += seconds
+        user += usage.ru_utime
+        system += usage.ru_stime
+        max_rss = max(max_rss, usage.ru_maxrss)
+        if returncode == 0:
+            break
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    max_rss *= 1 if sys.platform == "darwin" else 1024
+    nbytes = sum(f.size for f in server.files(recordID))
+    stats = server.reset_stats()
+    sent = stats.pop("sent", 0)
+    requests = stats.pop("requests", 0)
+    return {
+        "returncode": returncode,
+        "attempts": attempt + 1,
+        "wall": round(wall, 3),
+        "user": round(user, 3),
+        "system": round(system, 3),
+        "cpu": round(user + system, 3),
+        "max_rss": max_rss,
+        "bytes": nbytes,
+        "throughput": round(nbytes / wall, 1) if wall > 0 else None,
+        "requests": requests,
+        "sent": sent,
+        "retransferred": max(sent - nbytes, 0),
+        "faults": stats,
+    }
+
+
+def log_tail(workdir, lines=10):
+    with open(os.path.join(workdir, "zenodo_get.log"), "rb") as f:
+        return b"".join(f.readlines()[-lines:]).decode(errors="replace")
+
+
+def main(argv=None):
+    parser = OptionParser(
+        usage="%prog [options] [-- ZENODO_GET_ARGS]",
+        description="Benchmark zenodo_get against a local mock Zenodo server. "
+        "Scenarios: "
+        + ", ".join(f"{name} ({files})" for name, files in SCENARIOS.items())
+        + ".",
+    )
+    parser.add_option(
+        "-s",
+        "--scenario",
+        action="append",
+        default=[],
+        help="Scenario to run, can be repeated (small and large by default).",
+    )
+    parser.add_option(
+        "-f",
+        "--files",
+        action="append",
+        default=[],
+        help="Custom scenario of COUNTxSIZE[+COUNTxSIZE...] files, "
+        "e.g. 200x1M. Can be repeated.",
+    )
+    parser.add_option(
+        "-n",
+        "--repeat",
+        type="int",
+        default=1,
+        help="Number of runs of each scenario (1).",
+    )
+    parser.add_option(
+        "--doi",
+        action="store_true",
+        default=False,
+        help="Pass the DOI of the record, resolved by redirects, instead of its ID.",
+    )
+    parser.add_option(
+        "-w",
+        "--workdir",
+        default=None,
+        help="Directory for the downloads (a temporary directory). "
+        "It needs space for the largest scenario.",
+    )
+    parser.add_option(
+        "-o",
+        "--output",
+        default=None,
+        help="Write the results as JSON to this file (standard output).",
+    )
+    parser.add_option(
+        "-a",
+        "--attempts",
+        type="int",
+        default=1,
+        help="Run zenodo_get again after a failure, up to this many times in "
+        "total (1).",
+    )
+    parser.add_option(
+        "--seed",
+        type="int",
+        default=0,
+        help="Seed of the file content and of the faults (0).",
+    )
+    mock_zenodo.add_fault_options(parser)
+    (options, args) = parser.parse_args(argv)
+
+    scenarios = []
+    for name in options.scenario or ([] if options.files else ["small", "large"]):
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario: {name}")
+        scenarios.append((name, SCENARIOS[name]))
+    scenarios += [(spec, spec) for spec in options.files]
+
+    records = {
+        i + 1: mock_zenodo.parse_files(spec) for i, (_, spec) in enumerate(scenarios)
+    }
+    server = mock_zenodo.MockZenodo(
+        records, seed=options.seed, faults=mock_zenodo.make_faults(options)
+    )
+    print("Preparing the records ...", file=sys.stderr)
+    server.prepare()
+    server.start()
+
+    workdir = options.workdir or tempfile.mkdtemp(prefix="zenodo_get-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    failed = False
+    try:
+        for recordID, (name, spec) in enumerate(scenarios, 1):
+            for i in range(options.repeat):
+                result = {"scenario": name, "files": spec, "run": i + 1}
+                result.update(
+                    run(
+                        server,
+                        recordID,
+                        args,
+                        workdir,
+                        options.doi,
+                        options.attempts,
+                    )
+                )
+                results.append(result)
+                print(
+                    "{:<10} run {}: {:8.2f} s {:9.1f} MB/s {:8.2f} s CPU "
+                    "{:7.1f} MB RSS {:7.1f} MB resent{}".format(
+                        name,
+                        i + 1,
+                        result["wall"],
+                        (result["throughput"] or 0) / 2**20,
+                        result["cpu"],
+                        result["max_rss"] / 2**20,
+                        result["retransferred"] / 2**20,
+                        "" if result["returncode"] == 0 else "   FAILED",
+                    ),
+                    file=sys.stderr,
+                )
+                if result["returncode"] != 0:
+                    failed = True
+                    print(log_tail(workdir), file=sys.stderr)
+    finally:
+        server.shutdown()
+        server.server_close()
+        if options.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            shutil.rmtree(os.path.join(workdir, "out"), ignore_errors=True)
+
+    report = {
+        "version": version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "args": args,
+        "faults": server.faults.settings() if server.faults else None,
+        "results": results,
+    }
+    if options.output:
+        with open(options.output, "wt") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
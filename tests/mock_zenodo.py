@@ -0,0 +1,598 @@
+#!/usr/bin/env python3
+"""Local mock of the Zenodo API, for the benchmarks.
+
+Serves synthetic records: the metadata at /api/records/<id>, the files at
+/records/<id>/files/<name> (also /record/... and .../content) with single
+Range requests and If-Range, and DOI redirects at /doi/<doi>, where the
+record ID is the number at the end of the DOI (10.1234/bench.<id>).
+A record can also be a single zip archive (archive.zip) of synthetic files,
+for the extraction of zip members.
+
+Faults can be injected into the file transfers: added latency, throttled
+bandwidth, connections reset in the middle of a response, bursts of 429 or
+503 responses and corrupted bytes. Which request gets which fault depends
+only on the seed, the file and how many times the file has been requested,
+so the schedule is the same in every run, whatever the order of the
+requests.
+
+The content of the files is generated from one random block, so records
+of any size cost no memory or disk space. zenodo_get is pointed at the
+server with the ZENODO_URL and DOI_RESOLVER environment variables:
+
+    python3 tests/mock_zenodo.py --record 1:10000x10k --record 2:5x2G
+    ZENODO_URL=http://127.0.0.1:8000 zenodo_get 1
+"""
+
+import io
+import os
+import re
+import sys
+import json
+import time
+import random
+import socket
+import struct
+import zipfile
+import hashlib
+import threading
+from collections import Counter, defaultdict
+from optparse import OptionParser, OptionGroup
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from zenodo_get.ratelimit import parse_size, parse_rate  # noqa: E402
+
+BLOCK_SIZE = 2**20
+RECORD_PATH = re.compile(r"^/records?/(\d+)/files/([^/]+?)(?:/content)?$")
+THROTTLE_CHUNK = 2**16
+
+
+def parse_files(spec):
+    """Parse 'COUNTxSIZE[+COUNTxSIZE...]', e.g. '10000x10k' or '5x2G+1x1M'."""
+    files = []
+    for part in spec.split("+"):
+        count, _, size = part.lower().partition("x")
+        files.append((int(count), int(parse_size(size))))
+    return files
+
+
+def parse_record(spec):
+    """Parse 'ID:COUNTxSIZE[+COUNTxSIZE...]'."""
+    recordID, _, files = spec.partition(":")
+    return int(recordID), parse_files(files)
+
+
+class SyntheticFile:
+    """A file whose content is the random block of the server, repeated
+    from an offset which depends on the file."""
+
+    def __init__(self, block, name, size, offset):
+        self.block = block
+        self.name = name
+        self.size = size
+        self.offset = offset % BLOCK_SIZE
+        self.md5 = None
+
+    def chunks(self, start=0, end=None):
+        """Yield the content from start up to, and including, end."""
+        end = self.size - 1 if end is None else end
+        pos = start
+        while pos <= end:
+            n = min(BLOCK_SIZE, end + 1 - pos)
+            i = (self.offset + pos) % BLOCK_SIZE
+            yield self.block[i : i + n]
+            pos += n
+
+    def checksum(self):
+        h = hashlib.md5()
+        for chunk in self.chunks():
+            h.update(chunk)
+        self.md5 = h.hexdigest()
+        return self.md5
+
+
+class ArchiveFile(SyntheticFile):
+    """A zip archive of synthetic files, held in memory."""
+
+    def __init__(self, name, members):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+            for member in members:
+                with archive.open(f"data/{member.name}", "w") as f:
+                    for chunk in member.chunks():
+                        f.write(chunk)
+        data = buffer.getvalue()
+        super().__init__(memoryview(data), name, len(data), 0)
+
+    def chunks(self, start=0, end=None):
+        end = self.size - 1 if end is None else end
+        for pos in range(start, end + 1, BLOCK_SIZE):
+            yield self.block[pos : min(pos + BLOCK_SIZE, end + 1)]
+
+
+class Faults:
+    """Schedule of the faults injected into the file transfers.
+
+    Every request of a file first waits latency seconds, and is sent at
+    most at bandwidth bytes/s. With the probabilities resets, errors and
+    corrupt, the response is cut at a random offset, replaced by a burst
+    of burst error responses (status drawn from status, with Retry-After),
+    or has one byte flipped. A file gets at most max_faults faults, so
+    that a client with enough retries can always complete.
+    """
+
+    def __init__(
+        self,
+        latency=0.0,
+        bandwidth=0,
+        resets=0.0,
+        errors=0.0,
+        burst=1,
+        status=(429, 503),
+        retry_after=1,
+        corrupt=0.0,
+        max_faults=3,
+        seed=0,
+    ):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.resets = resets
+        self.errors = errors
+        self.burst = burst
+        self.status = status
+        self.retry_after = retry_after
+        self.corrupt = corrupt
+        self.max_faults = max_faults
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Restart the schedule, as if no file had been requested yet."""
+        self.requests = Counter()
+        self.faults = Counter()
+        self.bursts = defaultdict(int)
+
+    def settings(self):
+        return {
+            name: getattr(self, name)
+            for name in (
+                "latency",
+                "bandwidth",
+                "resets",
+                "errors",
+                "burst",
+                "status",
+                "retry_after",
+                "corrupt",
+                "max_faults",
+                "seed",
+            )
+        }
+
+    def plan(self, name, start, end):
+        """Decide the fault of the next request of a file: a dictionary
+        with the error status, or the offset of the reset or the corrupted
+        byte, or None."""
+        with self.lock:
+            n = self.requests[name]
+            self.requests[name] += 1
+            if self.faults[name] >= self.max_faults:
+                return None
+            rnd = random.Random(f"{self.seed}/{name}/{n}")
+            if self.bursts[name] > 0:
+                self.bursts[name] -= 1
+                return {"status": rnd.choice(self.status)}
+            fault = None
+            if rnd.random() < self.errors:
+                self.bursts[name] = self.burst - 1
+                fault = {"status": rnd.choice(self.status)}
+            elif rnd.random() < self.resets:
+                fault = {"reset": rnd.randint(start, end)}
+            elif rnd.random() < self.corrupt:
+                fault = {"corrupt": rnd.randint(start, end)}
+            if fault is not None:
+                self.faults[name] += 1
+            return fault
+
+
+class MockZenodo(ThreadingHTTPServer):
+    """The HTTP server. records maps record IDs to lists of (count, size)
+    pairs, and zips the IDs of the records served as one zip archive of
+    such files; faults is a Faults schedule, or None for a perfect server."""
+
+    daemon_threads = True
+
+    def __init__(
+        self, records, host="127.0.0.1", port=0, seed=0, faults=None, zips=None
+    ):
+        super().__init__((host, port), Handler)
+        self.faults = faults
+        self.stats_lock = threading.Lock()
+        self.stats = Counter()
+        # the block is stored twice, so any BLOCK_SIZE slice is contiguous
+        block = random.Random(seed).randbytes(BLOCK_SIZE)
+        self.block = memoryview(block + block)
+        self.records = {}
+        self.metadata = {}
+        for recordID, files in records.items():
+            self.add_record(recordID, files)
+        for recordID, files in (zips or {}).items():
+            self.add_zip(recordID, files)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def synthetic_files(self, recordID, files):
+        entries = {}
+        width = len(str(sum(count for count, size in files) - 1))
+        for count, size in files:
+            for _ in range(count):
+                i = len(entries)
+                name = f"file{i:0{width}d}.bin"
+                entries[name] = SyntheticFile(
+                    self.block, name, size, recordID * 104729 + i * 7919
+                )
+        return entries
+
+    def add_record(self, recordID, files):
+        self.records[recordID] = self.synthetic_files(recordID, files)
+
+    def add_zip(self, recordID, files):
+        members = self.synthetic_files(recordID, files).values()
+        archive = ArchiveFile("archive.zip", members)
+        self.records[recordID] = {archive.name: archive}
+
+    def prepare(self, jobs=None):
+        """Compute the checksums and metadata of all records."""
+        files = [f for entries in self.records.values() for f in entries.values()]
+        with ThreadPoolExecutor(jobs or os.cpu_count()) as pool:
+            list(pool.map(SyntheticFile.checksum, files))
+        for recordID, entries in self.records.items():
+            body = json.dumps(self.record_json(recordID, entries)).encode()
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            self.metadata[recordID] = (body, etag)
+
+    def record_json(self, recordID, entries):
+        return {
+            "id": recordID,
+            "metadata": {
+                "title": f"Synthetic record {recordID}",
+                "doi": f"10.1234/bench.{recordID}",
+                "publication_date": "2020-01-01",
+                "keywords": ["benchmark"],
+            },
+            "files": [
+                {
+                    "key": f.name,
+                    "size": f.size,
+                    "checksum": "md5:" + f.md5,
+                    "links": {
+                        "self": f"{self.url}/records/{recordID}/files/{f.name}/content"
+                    },
+                }
+                for f in entries.values()
+            ],
+        }
+
+    def start(self):
+        """Serve from a daemon thread; returns the thread."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def files(self, recordID):
+        return list(self.records[recordID].values())
+
+    def count(self, **values):
+        with self.stats_lock:
+            self.stats.update(values)
+
+    def handle_error(self, request, client_address):
+        # clients hang up on the server too, e.g. when they are aborted
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def reset_stats(self):
+        """Return the counters (requests, bytes sent and injected faults)
+        since the last call, and restart them."""
+        with self.stats_lock:
+            stats, self.stats = dict(self.stats), Counter()
+        return stats
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.dispatch(head=True)
+
+    def do_GET(self):
+        self.dispatch(head=False)
+
+    def dispatch(self, head):
+        path = self.path.split("?")[0]
+        m = re.match(r"^/api/records/(\d+)$", path)
+        if m:
+            return self.send_metadata(int(m.group(1)), head)
+        m = re.match(r"^/doi/(.+)\.(\d+)$", path)
+        if m:
+            self.send_response(302)
+            self.send_header("Location", f"/records/{m.group(2)}")
+            return self.send_empty()
+        m = RECORD_PATH.match(path)
+        if m:
+            entries = self.server.records.get(int(m.group(1)), {})
+            if m.group(2) in entries:
+                return self.send_file(entries[m.group(2)], head)
+        self.send_response(404)
+        self.send_empty()
+
+    def send_empty(self):
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_metadata(self, recordID, head):
+        if recordID not in self.server.metadata:
+            self.send_response(404)
+            return self.send_empty()
+        body, etag = self.server.metadata[recordID]
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            return self.send_empty()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def requested_range(self, f):
+        """Return (start, end) of the Range request, None for the whole file,
+        or False if the range cannot be satisfied."""
+        header = self.headers.get("Range")
+        if not header:
+            return None
+        etag = self.headers.get("If-Range")
+        if etag is not None and etag != f'"{f.md5}"':
+            return None
+        m = re.match(r"^bytes=(\d*)-(\d*)$", header.strip())
+        if not m or m.groups() == ("", ""):
+            return None
+        if m.group(1) == "":
+            start = max(f.size - int(m.group(2)), 0)
+            end = f.size - 1
+        else:
+            start = int(m.group(1))
+            end = min(int(m.group(2)), f.size - 1) if m.group(2) else f.size - 1
+        if start >= f.size or start > end:
+            return False
+        return start, end
+
+    def send_file(self, f, head):
+        self.server.count(requests=1)
+        faults = self.server.faults
+        if faults is not None:
+            time.sleep(faults.latency)
+        rng = self.requested_range(f)
+        if rng is False:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{f.size}")
+            return self.send_empty()
+        start, end = rng or (0, f.size - 1)
+        fault = None
+        if faults is not None and not head:
+            fault = faults.plan(f.name, start, end)
+        if fault is not None and "status" in fault:
+            self.server.count(**{str(fault["status"]): 1})
+            self.send_response(fault["status"])
+            self.send_header("Retry-After", str(faults.retry_after))
+            return self.send_empty()
+        if rng is None:
+            self.send_response(200)
+        else:
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{f.size}")
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", f'"{f.md5}"')
+        self.send_header("Content-Length", str(end + 1 - start))
+        self.end_headers()
+        if head:
+            return
+        try:
+            self.send_body(f, start, end, fault or {})
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def send_body(self, f, start, end, fault):
+        faults = self.server.faults
+        bandwidth = faults.bandwidth if faults is not None else 0
+        began = time.monotonic()
+        pos = start
+        for chunk in f.chunks(start, end):
+            if pos <= fault.get("corrupt", -1) < pos + len(chunk):
+                chunk = bytearray(chunk)
+                chunk[fault["corrupt"] - pos] ^= 0xFF
+                self.server.count(corrupted=1)
+            if pos <= fault.get("reset", -1) < pos + len(chunk):
+                chunk = chunk[: fault["reset"] - pos]
+            step = THROTTLE_CHUNK if bandwidth else max(len(chunk), 1)
+            for i in range(0, len(chunk), step):
+                data = chunk[i : i + step]
+                self.wfile.write(data)
+                self.server.count(sent=len(data))
+                if bandwidth:
+                    wait = began + (pos + i + len(data) - start) / bandwidth
+                    time.sleep(max(wait - time.monotonic(), 0))
+            pos += len(chunk)
+            if "reset" in fault and pos == fault["reset"]:
+                return self.reset()
+
+    def reset(self):
+        """Drop the connection with a TCP reset."""
+        self.server.count(resets=1)
+        self.wfile.flush()
+        self.connection.setsockopt(
+            socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0)
+        )
+        self.close_connection = True
+
+
+def add_fault_options(parser):
+    """Add the options of the injected faults to an OptionParser."""
+    group = OptionGroup(parser, "Faults")
+    group.add_option(
+        "--latency",
+        type="float",
+        default=0.0,
+        help="Seconds added before every file response (0).",
+    )
+    group.add_option(
+        "--bandwidth",
+        type="string",
+        default="0",
+        help="Bandwidth of every file response, e.g. 5M (bytes/s); "
+        "0 means unlimited (0).",
+    )
+    group.add_option(
+        "--resets",
+        type="float",
+        default=0.0,
+        help="Probability that a file response is reset in the middle (0).",
+    )
+    group.add_option(
+        "--errors",
+        type="float",
+        default=0.0,
+        help="Probability that a file request starts a burst of error "
+        "responses (0).",
+    )
+    group.add_option(
+        "--burst",
+        type="int",
+        default=1,
+        help="Number of consecutive error responses of a burst (1).",
+    )
+    group.add_option(
+        "--error-status",
+        default="429,503",
+        help="Comma separated statuses of the error responses (429,503).",
+    )
+    group.add_option(
+        "--retry-after",
+        type="int",
+        default=1,
+        help="Retry-After of the error responses in seconds (1).",
+    )
+    group.add_option(
+        "--corrupt",
+        type="float",
+        default=0.0,
+        help="Probability that a file response has a corrupted byte (0).",
+    )
+    group.add_option(
+        "--max-faults",
+        type="int",
+        default=3,
+        help="Maximum number of faults injected into the requests of one " "file (3).",
+    )
+    parser.add_option_group(group)
+
+
+def make_faults(options):
+    """Return the Faults of the parsed options, or None without faults."""
+    faults = Faults(
+        latency=options.latency,
+        bandwidth=parse_rate(options.bandwidth),
+        resets=options.resets,
+        errors=options.errors,
+        burst=options.burst,
+        status=[int(s) for s in options.error_status.split(",")],
+        retry_after=options.retry_after,
+        corrupt=options.corrupt,
+        max_faults=options.max_faults,
+        seed=options.seed,
+    )
+    if not (
+        faults.latency
+        or faults.bandwidth
+        or faults.resets
+        or faults.errors
+        or faults.corrupt
+    ):
+        return None
+    return faults
+
+
+def main(argv=None):
+    parser = OptionParser(
+        usage="%prog [options]", description="Serve synthetic Zenodo records."
+    )
+    parser.add_option(
+        "--host", default="127.0.0.1", help="Address to listen on (127.0.0.1)."
+    )
+    parser.add_option(
+        "--port", type="int", default=8000, help="Port to listen on (8000)."
+    )
+    parser.add_option(
+        "-r",
+        "--record",
+        action="append",
+        default=[],
+        help="Record as ID:COUNTxSIZE[+COUNTxSIZE...], e.g. 1:10000x10k "
+        "or 2:5x2G. Can be repeated.",
+    )
+    parser.add_option(
+        "-z",
+        "--zip",
+        action="append",
+        default=[],
+        help="Record of one zip archive of files as ID:COUNTxSIZE[+...], "
+        "whose members are data/<name>. Can be repeated.",
+    )
+    parser.add_option(
+        "--seed",
+        type="int",
+        default=0,
+        help="Seed of the file content and of the faults (0).",
+    )
+    add_fault_options(parser)
+    (options, args) = parser.parse_args(argv)
+    if not options.record and not options.zip:
+        parser.error("no record given (--record ID:COUNTxSIZE)")
+
+    records = dict(parse_record(spec) for spec in options.record)
+    zips = dict(parse_record(spec) for spec in options.zip)
+    server = MockZenodo(
+        records,
+        options.host,
+        options.port,
+        options.seed,
+        make_faults(options),
+        zips,
+    )
+    server.prepare()
+    print(
+        f"Serving {len(records) + len(zips)} record(s) at {server.url}",
+        file=sys.stderr,
+        flush=True,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
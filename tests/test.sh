@@ -1,7 +1,102 @@
 #!/bin/bash
 set -e
 
-CMD="python3 -m coverage run -a --source zenodo_get -m zenodo_get"
+CMD=${CMD:-"python3 -m coverage run -a --source zenodo_get -m zenodo_get"}
+HERE=$(cd "$(dirname "$0")" && pwd)
+
+# offline tests against the mock server (tests/mock_zenodo.py)
+WORK=$(mktemp -d)
+MOCK_PIDS=""
+trap 'kill $MOCK_PIDS 2>/dev/null; rm -rf "$WORK"' EXIT
+
+# start a mock server with the given options; $ZGET runs zenodo_get against it
+start_mock() {
+    log=$(mktemp "$WORK/mock.XXXX")
+    python3 "$HERE/mock_zenodo.py" --port 0 "$@" >/dev/null 2>"$log" &
+    MOCK_PIDS="$MOCK_PIDS $!"
+    until grep -q Serving "$log"; do
+        kill -0 $! || { cat "$log"; return 1; }
+        sleep 0.1
+    done
+    URL=$(sed -n 's/.* at //p' "$log")
+    ZGET="env ZENODO_URL=$URL DOI_RESOLVER=$URL/doi/ $CMD --no-cache"
+}
+
+start_mock -r 1:3x100k -r 2:1x10M -z 3:3x100k
+
+# download, md5sums.txt and verification
+$ZGET  1 -o "$WORK/1" -m
+$ZGET  1 -o "$WORK/1" -V
+$ZGET  -o "$WORK/1" -V
+echo x >> "$WORK/1/file1.bin"
+$ZGET  1 -o "$WORK/1" -V && false || true
+
+# file selection and batch mode, with DOIs
+$ZGET  10.1234/bench.1 -o "$WORK/g" -g 'file1*'
+test -f "$WORK/g/file1.bin" && test ! -e "$WORK/g/file0.bin"
+printf '1\n10.1234/bench.3\n' > "$WORK/ids.txt"
+$ZGET  -i "$WORK/ids.txt" -o "$WORK/batch" -j 2
+test -f "$WORK/batch/1/file2.bin" && test -f "$WORK/batch/3/archive.zip"
+
+# zip members: remote extraction and extraction while downloading
+$ZGET  3 -o "$WORK/z" -z '*/file1.bin'
+test -f "$WORK/z/data/file1.bin" && test ! -e "$WORK/z/data/file0.bin"
+test ! -e "$WORK/z/archive.zip"
+$ZGET  3 -o "$WORK/x" --extract
+test -f "$WORK/x/archive.zip" && test -f "$WORK/x/data/file2.bin"
+rm "$WORK/x/data/file0.bin"
+$ZGET  3 -o "$WORK/x" --extract
+test -f "$WORK/x/data/file0.bin"
+
+# asyncio API (if aiohttp is installed): a record, and a missing file, which
+# is a fatal error without retries
+if python3 -c "import aiohttp" 2>/dev/null; then
+    ZENODO_URL=$URL python3 - "$WORK/aio" <<'EOF'
+import sys
+import asyncio
+from zenodo_get import aio
+
+
+async def main(dest):
+    result = await aio.download_record("1", dest)
+    assert [f["status"] for f in result["files"]] == ["ok"] * 3, result["files"]
+    async with aio.make_session() as session:
+        missing = {"key": "missing.bin", "size": 10, "checksum": "md5:" + "0" * 32}
+        result = await aio.download_file(
+            session, missing, "1", dest + "/missing.bin", retries=3, pause=0.1
+        )
+    assert (result["status"], result["attempts"]) == ("fatal", 1), result
+
+
+asyncio.run(main(sys.argv[1]))
+EOF
+fi
+
+# resume: abort with two CTRL+C, then continue from the committed offset
+$ZGET  2 -o "$WORK/r" --limit-rate 2M &
+pid=$!
+sleep 2
+kill -INT $pid
+sleep 0.2
+kill -INT $pid
+wait $pid && false || true
+test -f "$WORK/r/file0.bin.part"
+$ZGET  2 -o "$WORK/r" --events "$WORK/resume.jsonl"
+grep -q '"event": "first_byte".*"offset": [1-9]' "$WORK/resume.jsonl"
+$ZGET  2 -o "$WORK/r" -V
+
+# corrupted transfers: every file is corrupted twice, then retried until
+# the checksum matches
+start_mock -r 1:3x100k --corrupt 1 --max-faults 2
+$ZGET  1 -o "$WORK/c" -R 0 && false || true
+$ZGET  1 -o "$WORK/c" -R 2 -p 0.1
+$ZGET  1 -o "$WORK/c" -V
+
+if [ -n "$OFFLINE" ]; then
+    echo "  OFFLINE TESTS ARE OK!  "
+    exit 0
+fi
+
 $CMD 
 $CMD  -h
 $CMD  --cite
@@ -18,5 +113,6 @@ $CMD  -r 1215979 -w urls.txt -n
 $CMD  -r 1215979 -w -
 $CMD  10.5281/zenodo.1215979 -R 3 -p 2 -n
 $CMD  -d 10.5281/zenodo.1215979
+$CMD  1215979 -j 4 -n
 
 echo "  TESTS ARE OK!  "
@@ -38,9 +38,18 @@ Zenodo. https://doi.org/"""
     + __doi__
 )
 
-try:  # wget and other libs might not be present at installation
-    from .zget import zenodo_get
+__all__ = ["zenodo_get", "download_record"]
 
-    __all__ = ["zenodo_get"]
-except:
+
+def zenodo_get(argv=None):
+    """Command line interface, see zenodo_get.zget.zenodo_get()."""
+    # imported on demand: the library does not need the command line part
+    from .zget import zenodo_get as main
+
+    return main(argv)
+
+
+try:  # requests might not be present at installation
+    from .api import download_record
+except ImportError:
     pass
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""asyncio interface of zenodo_get, built on aiohttp.
+
+The coroutines mirror zenodo_get.api: every transfer is a task on the event
+loop instead of an OS thread, so thousands of small files can be fetched
+concurrently. Cancelling a task stops its transfer like an abort does: the
+received part is committed and the next call resumes from there.
+
+aiohttp is an optional dependency: pip install zenodo_get[async]
+"""
+
+import os
+import time
+import asyncio
+import hashlib
+from urllib.parse import urljoin, urlparse
+from zenodo_get import api
+from zenodo_get import retry
+from zenodo_get import transfer
+from zenodo_get import verify
+
+try:
+    import aiohttp
+except ImportError:  # optional dependency
+    aiohttp = None
+
+
+def make_session(limit=100, timeout=15.0):
+    """Create an aiohttp session with up to limit connections."""
+    if aiohttp is None:
+        raise ImportError("The asyncio interface needs aiohttp: pip install aiohttp")
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=limit),
+        timeout=aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout),
+    )
+
+
+def check_response(r):
+    """Raise TransferError for transient HTTP errors, ClientResponseError
+    for the others."""
+    if r.status in retry.TRANSIENT_STATUS:
+        error = retry.TransferError(f"HTTP {r.status} {r.reason}")
+        # retry.retry_after() looks for the headers here
+        error.response = r
+        raise error
+    r.raise_for_status()
+
+
+async def resolve_doi(session, doi, timeout=15.0, max_redirects=10):
+    """Coroutine version of api.resolve_doi()."""
+    m = api.ZENODO_DOI.match(doi.strip())
+    if m:
+        return m.group(1)
+
+    url = doi if doi.startswith("http") else api.DOI_RESOLVER + doi
+    for _ in range(max_redirects):
+        m = api.RECORD_PATH.search(urlparse(url).path)
+        if m:
+            return m.group(1)
+        async with session.get(
+            url, allow_redirects=False, timeout=aiohttp.ClientTimeout(total=timeout)
+        ) as r:
+            if r.status not in (301, 302, 303, 307, 308):
+                return url.rstrip("/").split("/")[-1] if r.ok else None
+            url = urljoin(url, r.headers["Location"])
+    return None
+
+
+async def record_id(session, record, timeout=15.0):
+    """Return the record ID of a record ID or DOI.
+
+    Raises ValueError if the DOI cannot be resolved.
+    """
+    try:
+        return str(int(record))
+    except ValueError:
+        doi = str(record)
+    recordID = await resolve_doi(session, doi, timeout)
+    if recordID is None:
+        raise ValueError("DOI", doi)
+    return recordID.strip()
+
+
+async def fetch_metadata(
+    session, recordID, access_token=None, sandbox=False, timeout=15.0
+):
+    """Return the metadata of a record as JSON.
+
+    Raises ValueError if the record cannot be accessed.
+    """
+    url = api.base_url(sandbox) + "/api/records/" + str(recordID)
+    params = {}
+    if access_token:
+        params["access_token"] = access_token
+    async with session.get(
+        url, params=params, timeout=aiohttp.ClientTimeout(total=timeout)
+    ) as r:
+        if r.status != 200:
+            raise ValueError("Record could not get accessed.", recordID)
+        return await r.json(content_type=None)
+
+
+def hash_prefix(filename, h, size):
+    """Feed the first size bytes of filename into the hash object h."""
+    with open(filename, "rb") as f:
+        while size > 0:
+            data = f.read(min(transfer.CHUNK_SIZE, size))
+            if not data:
+                raise retry.TransferError(f"Unexpected end of file: {filename}")
+            h.update(data)
+            size -= len(data)
+
+
+def write_chunk(f, h, chunk):
+    f.write(chunk)
+    h.update(chunk)
+
+
+def commit(f, part, pos):
+    f.flush()
+    part.commit(0, pos)
+
+
+def close(f, part, pos):
+    try:
+        commit(f, part, pos)
+    finally:
+        f.close()
+
+
+async def transfer_file(session, part, params, algorithm, counter):
+    """Fetch the missing tail of a single range part file.
+
+    Returns the hex digest of the complete file.
+    """
+    state = part.state
+    start, end, pos = state["ranges"][0]
+    size = state["size"]
+    h = hashlib.new(algorithm)
+    headers = {}
+    if pos > 0:
+        headers["Range"] = f"bytes={pos}-{end}"
+        if state.get("etag"):
+            headers["If-Range"] = state["etag"]
+
+    try:
+        async with session.get(state["url"], params=params, headers=headers) as r:
+            check_response(r)
+            if r.status == 206:
+                content_range = r.headers.get("Content-Range", "")
+                if content_range != f"bytes {pos}-{end}/{size}":
+                    await asyncio.to_thread(part.discard)
+                    raise retry.TransferError(
+                        f"Unexpected Content-Range: {content_range}"
+                    )
+                await asyncio.to_thread(hash_prefix, part.part, h, pos)
+            else:
+                if r.content_length is not None and r.content_length != size:
+                    await asyncio.to_thread(part.discard)
+                    raise IOError(
+                        f"Remote size has changed: {r.content_length} != {size}"
+                    )
+                pos = 0
+            if state.get("etag") is None and r.headers.get("ETag"):
+                state["etag"] = r.headers["ETag"]
+
+            committed = pos
+            f = await asyncio.to_thread(open, part.part, "r+b")
+            # the disk write in progress; it runs in a thread and cannot be
+            # cancelled halfway, so it is waited for before the file is closed
+            writing = None
+            try:
+                f.seek(pos)
+                async for chunk in r.content.iter_chunked(transfer.CHUNK_SIZE):
+                    chunk = chunk[: end + 1 - pos]
+                    writing = asyncio.ensure_future(
+                        asyncio.to_thread(write_chunk, f, h, chunk)
+                    )
+                    await asyncio.shield(writing)
+                    writing = None
+                    pos += len(chunk)
+                    counter(len(chunk))
+                    if pos - committed >= transfer.COMMIT_INTERVAL:
+                        await asyncio.to_thread(commit, f, part, pos)
+                        committed = pos
+            finally:
+                if writing is not None:
+                    await writing
+                await asyncio.to_thread(close, f, part, pos)
+    except aiohttp.ClientResponseError:
+        # fatal HTTP status, from check_response()
+        raise
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise retry.TransferError(f"{type(e).__name__}: {e}") from e
+    if pos != end + 1:
+        raise retry.TransferError(f"Incomplete transfer: {pos} of {start}-{end}")
+    return h.hexdigest()
+
+
+async def download_file(
+    session,
+    f,
+    recordID,
+    filename,
+    access_token=None,
+    sandbox=False,
+    resume=True,
+    retries=0,
+    pause=0.5,
+    keep=False,
+    hash_cache=None,
+):
+    """Download one file entry of a record into filename, and verify it.
+
+    Same semantics and result dictionary as api.download_file(), but the
+    file is always fetched over one connection. The transfer can be
+    cancelled at any time; it resumes from the last committed offset.
+    """
+    result = api.file_result(f, filename)
+    size = result["size"]
+    algorithm, checksum = result["algorithm"], result["expected"]
+    start = time.monotonic()
+
+    if resume:
+        remote_hash, local_hash = await asyncio.to_thread(
+            api.check_hash, filename, f["checksum"], hash_cache
+        )
+        if remote_hash == local_hash:
+            result.update(status="exists", actual=local_hash)
+            return result
+
+    params = {}
+    if access_token:
+        params["access_token"] = access_token
+    link = api.file_url(recordID, result["file"], sandbox)
+
+    def counter(n):
+        result["bytes"] += n
+
+    policy = retry.RetryPolicy(retries, pause)
+    error = None
+    attempt = 0
+    while True:
+        result["attempts"] = attempt + 1
+        try:
+            part = transfer.PartFile(filename)
+            state = None
+            if resume:
+                state = await asyncio.to_thread(part.load, link, size, checksum)
+            if state is None:
+                await asyncio.to_thread(
+                    part.create, link, size, checksum, [[0, size - 1, 0]]
+                )
+            digest = await transfer_file(session, part, params, algorithm, counter)
+            result["actual"] = digest
+            if digest != checksum:
+                raise retry.ChecksumError(filename, checksum, digest)
+            await asyncio.to_thread(part.finish)
+        except Exception as e:
+            error = e
+            if not policy.should_retry(attempt, e):
+                break
+            if isinstance(e, retry.ChecksumError):
+                await asyncio.to_thread(part.discard)
+            await asyncio.sleep(policy.delay(attempt, e))
+            attempt += 1
+            resume = True
+        else:
+            if hash_cache is not None:
+                await asyncio.to_thread(hash_cache.put, filename, algorithm, digest)
+            result["status"] = "ok"
+            result["duration"] = time.monotonic() - start
+            return result
+
+    result["duration"] = time.monotonic() - start
+    result["error"] = str(error)
+    if isinstance(error, retry.ChecksumError):
+        result["status"] = "mismatch"
+        if keep:
+            await asyncio.to_thread(part.finish)
+        else:
+            await asyncio.to_thread(part.discard)
+    elif retry.is_transient(error):
+        result["status"] = "error"
+    else:
+        result["status"] = "fatal"
+    return result
+
+
+async def download_record(
+    record,
+    dest,
+    session=None,
+    jobs=16,
+    access_token=None,
+    sandbox=False,
+    resume=True,
+    retries=0,
+    pause=0.5,
+    timeout=15.0,
+    keep=False,
+    hash_cache=None,
+    include=None,
+    exclude=None,
+    regex=None,
+    min_size=None,
+    max_size=None,
+):
+    """Download the files of a record (ID or DOI) into the directory dest.
+
+    Up to jobs files are transferred at the same time, and the files are
+    selected as in api.download_record(). Returns the same dictionary as
+    api.download_record(). If the task is cancelled, the running transfers
+    are stopped and can be resumed by the next call.
+    """
+    owned = session is None
+    if owned:
+        session = make_session(jobs, timeout)
+    try:
+        start = time.monotonic()
+        recordID = await record_id(session, record, timeout)
+        js = await fetch_metadata(session, recordID, access_token, sandbox, timeout)
+        # a concept record ID resolves to its latest version
+        recordID = str(js.get("id", recordID))
+        files = api.select_files(
+            js["files"], include, exclude, regex, min_size, max_size
+        )
+        await asyncio.to_thread(os.makedirs, dest, exist_ok=True)
+
+        semaphore = asyncio.Semaphore(jobs)
+
+        async def fetch(f):
+            async with semaphore:
+                return await download_file(
+                    session,
+                    f,
+                    recordID,
+                    os.path.join(dest, f.get("filename") or f["key"]),
+                    access_token=access_token,
+                    sandbox=sandbox,
+                    resume=resume,
+                    retries=retries,
+                    pause=pause,
+                    keep=keep,
+                    hash_cache=hash_cache,
+                )
+
+        results = await asyncio.gather(*(fetch(f) for f in files))
+    finally:
+        if owned:
+            await session.close()
+    return {
+        "record": recordID,
+        "metadata": js,
+        "files": list(results),
+        "bytes": sum(r["bytes"] for r in results),
+        "duration": time.monotonic() - start,
+    }
+
+
+async def verify_files(entries, hash_cache=None, jobs=None):
+    """Verify (filename, checksum) pairs; hashing runs in worker threads.
+
+    Returns one result dictionary per file, in the order of entries.
+    """
+    semaphore = asyncio.Semaphore(jobs or os.cpu_count() or 1)
+
+    async def check(filename, checksum):
+        async with semaphore:
+            return await asyncio.to_thread(
+                verify.verify_file, filename, checksum, hash_cache
+            )
+
+    return list(
+        await asyncio.gather(*(check(name, checksum) for name, checksum in entries))
+    )
@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+"""Library interface of zenodo_get.
+
+These functions take explicit paths, report through return values and
+exceptions, and never change the working directory, print or exit, so they
+can be called from several threads of one process at the same time.
+"""
+
+import os
+import re
+import time
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urljoin, urlparse
+from zenodo_get import transfer
+from zenodo_get import verify
+from zenodo_get import retry
+from zenodo_get import remotezip
+from zenodo_get.events import emit, throughput
+from zenodo_get.profiler import phase
+
+ZENODO_DOI = re.compile(
+    r"^(?:https?://(?:dx\.)?doi\.org/)?10\.5281/zenodo\.(\d+)$", re.IGNORECASE
+)
+RECORD_PATH = re.compile(r"/records?/(\d+)/?$")
+
+# the servers can be replaced, e.g. by the mock server of the benchmarks
+ZENODO_URL = os.environ.get("ZENODO_URL", "https://zenodo.org")
+SANDBOX_URL = os.environ.get("ZENODO_SANDBOX_URL", "https://sandbox.zenodo.org")
+DOI_RESOLVER = os.environ.get("DOI_RESOLVER", "https://doi.org/")
+
+
+def base_url(sandbox=False):
+    return (SANDBOX_URL if sandbox else ZENODO_URL).rstrip("/")
+
+
+def file_url(recordID, fname, sandbox=False):
+    return unquote("{}/record/{}/files/{}".format(base_url(sandbox), recordID, fname))
+
+
+def check_hash(filename, checksum, hash_cache=None):
+    algorithm, value = verify.parse_checksum(checksum)
+    if not os.path.exists(filename):
+        return value, "invalid"
+    if hash_cache is not None:
+        digest = hash_cache.get(filename, algorithm)
+        if digest is not None:
+            return value, digest
+    digest = verify.file_digest(filename, algorithm)
+    if hash_cache is not None and digest == value:
+        hash_cache.put(filename, algorithm, digest)
+    return value, digest
+
+
+def resolve_doi(session, doi, timeout=15.0, max_redirects=10):
+    """Find the record ID of a DOI without downloading the landing page.
+
+    Zenodo DOIs contain the record ID. Other DOIs are resolved by following
+    the redirects one by one, stopping at the first Zenodo record URL.
+    Returns None if the DOI cannot be resolved.
+    """
+    m = ZENODO_DOI.match(doi.strip())
+    if m:
+        return m.group(1)
+
+    url = doi if doi.startswith("http") else DOI_RESOLVER + doi
+    for _ in range(max_redirects):
+        m = RECORD_PATH.search(urlparse(url).path)
+        if m:
+            return m.group(1)
+        with session.get(url, timeout=timeout, allow_redirects=False, stream=True) as r:
+            if not r.is_redirect:
+                return url.rstrip("/").split("/")[-1] if r.ok else None
+            url = urljoin(url, r.headers["Location"])
+    return None
+
+
+def record_id(session, record, timeout=15.0, doi_cache=None, offline=False):
+    """Return the record ID of a record ID or DOI.
+
+    Raises ValueError if the DOI cannot be resolved.
+    """
+    try:
+        return str(int(record))
+    except ValueError:
+        doi = str(record)
+
+    start = time.monotonic()
+    recordID = None
+    source = "doi"
+    m = ZENODO_DOI.match(doi.strip())
+    if m:
+        recordID = m.group(1)
+    elif doi_cache is not None:
+        recordID = doi_cache.get(doi, offline=offline)
+        source = "cache"
+    if recordID is None and not offline:
+        with phase(session, "resolve"):
+            recordID = resolve_doi(session, doi, timeout)
+        source = "network"
+        if recordID is not None and doi_cache is not None:
+            doi_cache.put(doi, recordID)
+    emit(
+        session,
+        "resolve",
+        doi=doi,
+        record=recordID,
+        source=source,
+        duration=round(time.monotonic() - start, 6),
+    )
+    if recordID is None:
+        raise ValueError("DOI", doi)
+    return recordID.strip()
+
+
+def fetch_metadata(
+    session,
+    recordID,
+    access_token=None,
+    sandbox=False,
+    timeout=15.0,
+    metadata_cache=None,
+    offline=False,
+):
+    """Return the metadata of a record as JSON.
+
+    Raises ValueError if the record cannot be accessed, and the requests
+    exceptions on connection errors.
+    """
+    url = base_url(sandbox) + "/api/records/" + str(recordID)
+    params = {}
+    if access_token:
+        params["access_token"] = access_token
+
+    start = time.monotonic()
+    with phase(session, "metadata"):
+        if metadata_cache is None:
+            r = session.get(url, params=params, timeout=timeout)
+            with phase(session, "metadata.parse"):
+                js = r.json() if r.ok else None
+        else:
+            js = metadata_cache.get(
+                session, url, params=params, timeout=timeout, offline=offline
+            )
+    emit(
+        session,
+        "metadata",
+        record=str(recordID),
+        ok=js is not None,
+        files=len(js.get("files", [])) if js is not None else None,
+        duration=round(time.monotonic() - start, 6),
+    )
+    if js is None:
+        raise ValueError("Record could not get accessed.", recordID)
+    return js
+
+
+def select_files(
+    files, include=None, exclude=None, regex=None, min_size=None, max_size=None
+):
+    """Filter the file entries of a record by their key and size.
+
+    A file is selected if it matches any of the include glob patterns or
+    regular expressions (or neither is given), it matches none of the
+    exclude glob patterns, and its size is within min_size and max_size.
+    """
+    include = list(include or [])
+    exclude = list(exclude or [])
+    regex = [re.compile(r) for r in regex or []]
+    selected = []
+    for f in files:
+        key = f.get("filename") or f["key"]
+        size = f.get("filesize") or f["size"]
+        if (include or regex) and not (
+            any(fnmatch.fnmatchcase(key, p) for p in include)
+            or any(r.search(key) for r in regex)
+        ):
+            continue
+        if any(fnmatch.fnmatchcase(key, p) for p in exclude):
+            continue
+        if min_size is not None and size < min_size:
+            continue
+        if max_size is not None and size > max_size:
+            continue
+        selected.append(f)
+    return selected
+
+
+def file_result(f, filename):
+    """Initial result dictionary of the file entry f stored at filename."""
+    algorithm, checksum = verify.parse_checksum(f["checksum"])
+    return {
+        "file": f.get("filename") or f["key"],
+        "path": filename,
+        "size": f.get("filesize") or f["size"],
+        "algorithm": algorithm,
+        "expected": checksum,
+        "actual": None,
+        "status": None,
+        "bytes": 0,
+        "duration": 0.0,
+        "attempts": 0,
+        "error": None,
+    }
+
+
+def download_file(
+    session,
+    f,
+    recordID,
+    filename,
+    access_token=None,
+    sandbox=False,
+    resume=True,
+    segments=1,
+    segment_threshold=64 * 2**20,
+    retries=0,
+    pause=0.5,
+    timeout=15.0,
+    keep=False,
+    paranoid=False,
+    hash_cache=None,
+    abort=None,
+    progress=None,
+    log=None,
+    extract=None,
+    keep_archive=True,
+):
+    """Download one file entry of a record into filename, and verify it.
+
+    Transient errors are retried with backoff, up to retries times. A file
+    with an incorrect checksum is deleted unless keep is set. If abort()
+    becomes true during a transfer, the exception is raised; an interrupted
+    transfer can be resumed later.
+
+    If extract is a list of glob patterns, the matching members of the zip
+    archive are extracted next to it while it is downloaded, and with
+    keep_archive=False the archive itself is not stored at all.
+
+    Returns a result dictionary; its status is "ok", "exists" (the file was
+    already present and correct), "mismatch", "error" (retries exhausted)
+    or "fatal". The names of extracted zip members are under "members".
+    """
+    log = log or (lambda *args: None)
+    result = file_result(f, filename)
+    fname, size = result["file"], result["size"]
+    algorithm, checksum = result["algorithm"], result["expected"]
+    start = time.monotonic()
+
+    def done():
+        result["duration"] = time.monotonic() - start
+        emit(
+            session,
+            "complete",
+            file=filename,
+            status=result["status"],
+            bytes=result["bytes"],
+            duration=round(result["duration"], 6),
+            throughput=throughput(result["bytes"], result["duration"]),
+            attempts=result["attempts"],
+            error=result["error"],
+        )
+        return result
+
+    with phase(session, "hash.existing"):
+        remote_hash, local_hash = check_hash(filename, f["checksum"], hash_cache)
+    if local_hash != "invalid":
+        emit(
+            session,
+            "checksum",
+            file=filename,
+            source="local",
+            algorithm=algorithm,
+            expected=checksum,
+            actual=local_hash,
+            ok=local_hash == checksum,
+        )
+    if remote_hash == local_hash and resume:
+        log(f"{filename} is already downloaded correctly.")
+        result.update(status="exists", actual=local_hash)
+        if extract is not None:
+            with phase(session, "extract"):
+                result["members"] = remotezip.extract_file(
+                    filename, extract, os.path.dirname(filename), log
+                )
+            if not keep_archive:
+                os.remove(filename)
+        return done()
+
+    params = {}
+    if access_token:
+        params["access_token"] = access_token
+    if size < segment_threshold:
+        segments = 1
+    link = file_url(recordID, fname, sandbox)
+
+    policy = retry.RetryPolicy(retries, pause)
+    extractor = None
+    error = None
+    attempt = 0
+    while True:
+        result["attempts"] = attempt + 1
+        try:
+            if extract is not None and extractor is None:
+                infos, n = remotezip.read_directory(
+                    session, link, size, params, timeout, abort=abort
+                )
+                result["bytes"] += n
+                extractor = remotezip.Extractor(
+                    infos, extract, os.path.dirname(filename), log
+                )
+                if not keep_archive and not extractor.pending():
+                    log(f"{fname} is already extracted correctly.")
+                    result["status"] = "exists"
+                    result["members"] = [i.filename for i in extractor.infos]
+                    return done()
+            with phase(session, "transfer"):
+                n, digest = transfer.download(
+                    session,
+                    link,
+                    filename,
+                    size,
+                    checksum=checksum,
+                    algorithm=algorithm,
+                    segments=max(segments, 1),
+                    resume=resume,
+                    params=params,
+                    timeout=timeout,
+                    abort=abort,
+                    progress=progress,
+                    sink=extractor,
+                    store=keep_archive or extractor is None,
+                )
+            result["bytes"] += n
+            if progress is not None:
+                log()
+            source = "stream"
+            if paranoid and os.path.exists(filename):
+                with phase(session, "verify"):
+                    digest = check_hash(filename, f["checksum"])[1]
+                source = "reread"
+            result["actual"] = digest
+            emit(
+                session,
+                "checksum",
+                file=filename,
+                source=source,
+                algorithm=algorithm,
+                expected=checksum,
+                actual=digest,
+                ok=digest == checksum,
+            )
+            if digest != checksum:
+                raise retry.ChecksumError(filename, checksum, digest)
+            if extractor is not None:
+                result["members"] = extractor.finish()
+        except Exception as e:
+            if abort is not None and abort():
+                raise
+            error = e
+            if isinstance(e, retry.ChecksumError):
+                log(f"Checksum is INCORRECT!({e.expected} got:{e.actual})")
+            else:
+                log(f"  Download error: {e}. Original link: {link}")
+            if not policy.should_retry(attempt, e):
+                break
+            delay = policy.delay(attempt, e)
+            if isinstance(e, retry.ChecksumError):
+                # do not resume from corrupt data
+                transfer.PartFile(filename).discard()
+                if os.path.exists(filename):
+                    os.remove(filename)
+            log(f"  Retrying in {delay:.1f} s.")
+            emit(
+                session,
+                "retry",
+                file=filename,
+                attempt=attempt + 1,
+                delay=round(delay, 3),
+                error=str(e),
+            )
+            policy.sleep(delay, abort)
+            attempt += 1
+            # later attempts continue from what has been received so far
+            resume = True
+        else:
+            log(f"Checksum is correct. ({checksum})  {filename}")
+            if hash_cache is not None and os.path.exists(filename):
+                hash_cache.put(filename, algorithm, digest)
+            result["status"] = "ok"
+            return done()
+
+    result["error"] = str(error)
+    if isinstance(error, retry.ChecksumError):
+        result["status"] = "mismatch"
+        if not keep and os.path.exists(filename):
+            os.remove(filename)
+    elif retry.is_transient(error):
+        result["status"] = "error"
+    else:
+        result["status"] = "fatal"
+    return done()
+
+
+def download_record(
+    record,
+    dest,
+    session=None,
+    jobs=1,
+    access_token=None,
+    sandbox=False,
+    resume=True,
+    segments=1,
+    segment_threshold=64 * 2**20,
+    retries=0,
+    pause=0.5,
+    timeout=15.0,
+    keep=False,
+    paranoid=False,
+    hash_cache=None,
+    metadata_cache=None,
+    doi_cache=None,
+    abort=None,
+    include=None,
+    exclude=None,
+    regex=None,
+    min_size=None,
+    max_size=None,
+    extract=None,
+    keep_archive=True,
+):
+    """Download all files of a record (ID or DOI) into the directory dest.
+
+    Only the files selected by include, exclude, regex, min_size and
+    max_size are downloaded, see select_files(). The extract and
+    keep_archive arguments apply to the zip archives of the record, see
+    download_file().
+
+    Files are fetched over jobs parallel connections of the session (if
+    none is given, a new one is created and closed at the end). Failed
+    files do not stop the others; if abort() becomes true, the remaining
+    files are not started and the running transfers stop at their next
+    chunk.
+
+    Returns a dictionary with the record ID, its metadata, the total number
+    of bytes transferred, the duration, and one result per file as
+    returned by download_file(), with status "aborted" for files which
+    were not finished. Concurrent calls must not share a dest directory.
+    """
+    owned = session is None
+    if owned:
+        session = transfer.make_session(jobs * max(segments, 1))
+    try:
+        start = time.monotonic()
+        recordID = record_id(session, record, timeout, doi_cache)
+        js = fetch_metadata(
+            session, recordID, access_token, sandbox, timeout, metadata_cache
+        )
+        # a concept record ID resolves to its latest version
+        recordID = str(js.get("id", recordID))
+        files = select_files(js["files"], include, exclude, regex, min_size, max_size)
+        os.makedirs(dest, exist_ok=True)
+
+        def stopped():
+            return abort is not None and abort()
+
+        def fetch(f):
+            filename = os.path.join(dest, f.get("filename") or f["key"])
+            try:
+                if stopped():
+                    raise Exception("Immediate abort")
+                return download_file(
+                    session,
+                    f,
+                    recordID,
+                    filename,
+                    access_token=access_token,
+                    sandbox=sandbox,
+                    resume=resume,
+                    segments=segments,
+                    segment_threshold=segment_threshold,
+                    retries=retries,
+                    pause=pause,
+                    timeout=timeout,
+                    keep=keep,
+                    paranoid=paranoid,
+                    hash_cache=hash_cache,
+                    abort=abort,
+                    extract=extract if filename.lower().endswith(".zip") else None,
+                    keep_archive=keep_archive,
+                )
+            except Exception as e:
+                if not stopped():
+                    raise
+                result = file_result(f, filename)
+                result.update(status="aborted", error=str(e))
+                return result
+
+        if jobs <= 1:
+            results = [fetch(f) for f in files]
+        else:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                results = list(executor.map(fetch, files))
+    finally:
+        if owned:
+            session.close()
+    return {
+        "record": recordID,
+        "metadata": js,
+        "files": results,
+        "bytes": sum(r["bytes"] for r in results),
+        "duration": time.monotonic() - start,
+    }
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import Counter
+from zenodo_get.profiler import phase
+
+
+def cache_dir():
+    """Default cache location: $XDG_CACHE_HOME/zenodo_get or ~/.cache/zenodo_get."""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "zenodo_get")
+
+
+def load_json(path, default):
+    try:
+        with open(path, "rt") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmpfile = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmpfile, "wt") as f:
+        json.dump(data, f)
+    os.replace(tmpfile, path)
+
+
+class HashCache:
+    """Persistent store of verified file digests.
+
+    Entries are keyed on the absolute path and are only valid while the
+    size, modification time and inode of the file are unchanged, so an
+    unmodified file never has to be hashed again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = load_json(path, {})
+        self.updates = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(filename):
+        st = os.stat(filename)
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def get(self, filename, algorithm):
+        """Return the cached digest of filename, or None if it is unknown or stale."""
+        key = os.path.abspath(filename)
+        with self.lock:
+            entry = self.updates.get(key) or self.entries.get(key)
+        if entry is None or entry[3] != algorithm:
+            return None
+        try:
+            if entry[:3] != self.fingerprint(filename):
+                return None
+        except OSError:
+            return None
+        return entry[4]
+
+    def put(self, filename, algorithm, digest):
+        key = os.path.abspath(filename)
+        entry = self.fingerprint(filename) + [algorithm, digest]
+        with self.lock:
+            self.updates[key] = entry
+
+    def save(self):
+        """Merge the new entries into the cache file."""
+        with self.lock:
+            if not self.updates:
+                return
+            entries = load_json(self.path, {})
+            entries.update(self.updates)
+            save_json(self.path, entries)
+            self.entries = entries
+            self.updates = {}
+
+
+class MetadataCache:
+    """Record metadata stored on disk and revalidated with conditional requests.
+
+    A cached response younger than ttl seconds is used without contacting
+    the server. Older entries are revalidated with If-None-Match and
+    If-Modified-Since; a 304 answer refreshes the entry and the stored JSON
+    is reused. In offline mode only the cache is consulted.
+    """
+
+    def __init__(self, directory, ttl=600.0):
+        self.directory = os.path.join(directory, "metadata")
+        self.ttl = ttl
+
+    def path(self, url, params=None):
+        key = (
+            url + "?" + "&".join(f"{k}={v}" for k, v in sorted((params or {}).items()))
+        )
+        return os.path.join(
+            self.directory, hashlib.sha256(key.encode()).hexdigest() + ".json"
+        )
+
+    def get(self, session, url, params=None, timeout=15.0, offline=False):
+        """Return the JSON document at url, or None if it is not available."""
+        path = self.path(url, params)
+        entry = load_json(path, None)
+        if entry is not None:
+            age = time.time() - entry["fetched"]
+            if offline or age < self.ttl:
+                return entry["json"]
+        if offline:
+            return None
+
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        r = session.get(url, params=params, headers=headers, timeout=timeout)
+        if r.status_code == 304 and entry is not None:
+            entry["fetched"] = time.time()
+            save_json(path, entry)
+            return entry["json"]
+        if not r.ok:
+            return None
+        with phase(session, "metadata.parse"):
+            js = r.json()
+        save_json(
+            path,
+            {
+                "url": url,
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+                "fetched": time.time(),
+                "json": js,
+            },
+        )
+        return js
+
+
+class DOICache:
+    """Persistent DOI -> record ID mapping, valid for ttl seconds.
+
+    DOIs are resolved from several threads in batch mode, so the file is
+    read and rewritten under a lock.
+    """
+
+    def __init__(self, directory, ttl=600.0):
+        self.path = os.path.join(directory, "dois.json")
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    def get(self, doi, offline=False):
+        with self.lock:
+            entry = load_json(self.path, {}).get(doi.lower())
+        if entry is None:
+            return None
+        recordID, fetched = entry
+        if offline or time.time() - fetched < self.ttl:
+            return recordID
+        return None
+
+    def put(self, doi, recordID):
+        with self.lock:
+            entries = load_json(self.path, {})
+            entries[doi.lower()] = [recordID, time.time()]
+            save_json(self.path, entries)
+
+
+class BlockCache:
+    """Blocks of remote files kept on disk, up to quota bytes.
+
+    The blocks of a file are stored at their offsets in a sparse file,
+    <key>.data, and <key>.bitmap marks the blocks which are present. The
+    key combines the record, the checksum of the file and the block size,
+    so a changed file is never served from stale blocks. When the quota
+    is exceeded, the least recently used files which are not open are
+    removed.
+    """
+
+    def __init__(self, directory, quota=2**30, blocksize=2**16):
+        self.directory = os.path.join(directory, "blocks")
+        self.quota = quota
+        self.blocksize = blocksize
+        self.lock = threading.Lock()
+        self.used = {}
+        self.access = {}
+        self.open_files = Counter()
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            if name.endswith(".bitmap"):
+                key = name[: -len(".bitmap")]
+                path = os.path.join(self.directory, name)
+                try:
+                    blocksize = int(key.rpartition("-")[2])
+                    with open(path, "rb") as f:
+                        present = count_bits(f.read())
+                    self.access[key] = os.stat(path).st_mtime
+                except (OSError, ValueError):
+                    # not a file of the cache
+                    continue
+                self.used[key] = present * blocksize
+
+    def key(self, record, checksum):
+        algorithm, _, digest = checksum.rpartition(":")
+        return f"{record}-{algorithm or 'md5'}-{digest}-{self.blocksize}"
+
+    def open(self, record, checksum, size):
+        """Return the CachedFile of a remote file."""
+        return CachedFile(self, self.key(record, checksum), size)
+
+    def remove(self, key):
+        for suffix in (".data", ".bitmap"):
+            try:
+                os.remove(os.path.join(self.directory, key + suffix))
+            except OSError:
+                pass
+
+    def reserve(self, key, nbytes):
+        """Account nbytes more to key, evicting the least recently used files
+        as needed. Returns False if they do not fit into the quota."""
+        with self.lock:
+            self.access[key] = time.time()
+            total = sum(self.used.values())
+            for victim in sorted(self.used, key=lambda k: self.access.get(k, 0)):
+                if total + nbytes <= self.quota:
+                    break
+                if victim == key or self.open_files[victim]:
+                    continue
+                total -= self.used.pop(victim)
+                self.access.pop(victim, None)
+                self.remove(victim)
+            if total + nbytes > self.quota:
+                return False
+            self.used[key] = self.used.get(key, 0) + nbytes
+            return True
+
+    def opened(self, key, nbytes):
+        with self.lock:
+            self.open_files[key] += 1
+            self.used[key] = nbytes
+            self.access[key] = time.time()
+
+    def closed(self, key):
+        with self.lock:
+            self.open_files[key] -= 1
+
+
+class CachedFile:
+    """One file of a BlockCache. get() and put() read and write whole blocks
+    and can be called from several threads."""
+
+    def __init__(self, cache, key, size):
+        self.cache = cache
+        self.key = key
+        self.size = size
+        self.blocksize = cache.blocksize
+        self.nblocks = -(-size // self.blocksize)
+        base = os.path.join(cache.directory, key)
+        self.bitmap_path = base + ".bitmap"
+        self.lock = threading.Lock()
+        self.dirty = 0
+        try:
+            with open(self.bitmap_path, "rb") as f:
+                self.bitmap = bytearray(f.read())
+        except OSError:
+            self.bitmap = bytearray()
+        if len(self.bitmap) != (self.nblocks + 7) // 8:
+            self.bitmap = bytearray((self.nblocks + 7) // 8)
+        self.fd = os.open(base + ".data", os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size != size:
+            # a sparse file: the blocks which are not written take no space
+            os.ftruncate(self.fd, size)
+        cache.opened(key, count_bits(self.bitmap) * self.blocksize)
+
+    def __contains__(self, index):
+        return bool(self.bitmap[index >> 3] & (1 << (index & 7)))
+
+    def complete(self):
+        return all(i in self for i in range(self.nblocks))
+
+    def length(self, index):
+        return min(self.blocksize, self.size - index * self.blocksize)
+
+    def get(self, index):
+        """Return block index, or None if it is not in the cache."""
+        if index not in self:
+            return None
+        data = os.pread(self.fd, self.length(index), index * self.blocksize)
+        return data if len(data) == self.length(index) else None
+
+    def put(self, index, data):
+        if index in self or len(data) != self.length(index):
+            return
+        if not self.cache.reserve(self.key, self.blocksize):
+            return
+        os.pwrite(self.fd, data, index * self.blocksize)
+        with self.lock:
+            # the bitmap is only updated after the block is written
+            self.bitmap[index >> 3] |= 1 << (index & 7)
+            self.dirty += 1
+            if self.dirty >= 64:
+                self.save()
+
+    def save(self):
+        tmpfile = f"{self.bitmap_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmpfile, "wb") as f:
+            f.write(self.bitmap)
+        os.replace(tmpfile, self.bitmap_path)
+        self.dirty = 0
+
+    def close(self):
+        with self.lock:
+            self.save()
+        os.close(self.fd)
+        self.cache.closed(self.key)
+
+
+def count_bits(data):
+    return sum(bin(byte).count("1") for byte in data)
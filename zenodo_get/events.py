@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+import sys
+import json
+import time
+import threading
+
+
+class EventLog:
+    """Machine readable log of the transfers: one JSON object per line.
+
+    Every event has the wall clock "time" (seconds since the epoch) and its
+    name in "event"; the other fields depend on the event. The log is
+    attached to the HTTP session (session.events), so every layer which
+    has the session can report to it. Events are written and flushed one
+    by one, from any thread.
+    """
+
+    def __init__(self, filename):
+        if filename == "-":
+            self.file = sys.stdout
+        else:
+            self.file = open(filename, "at")
+        self.lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        line = json.dumps({"time": round(time.time(), 6), "event": event, **fields})
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+def emit(session, event, **fields):
+    """Report an event to the log of the session, if it has one."""
+    events = getattr(session, "events", None)
+    if events is not None:
+        events.emit(event, **fields)
+
+
+def throughput(nbytes, seconds):
+    return round(nbytes / seconds, 1) if seconds > 0 else None
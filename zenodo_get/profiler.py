@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+import time
+import cProfile
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Profiler:
+    """Time spent in each phase of a run.
+
+    The phases are timed with the wall clock in every thread and summed,
+    so with parallel transfers they can add up to more than the duration
+    of the run. Optionally the main thread also runs under cProfile, and
+    its statistics can be written to a pstats file.
+    """
+
+    def __init__(self, cprofile=False):
+        self.start = time.monotonic()
+        self.times = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.lock = threading.Lock()
+        self.cprofile = None
+        if cprofile:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self.lock:
+                self.times[name] += elapsed
+                self.counts[name] += 1
+
+    def dump(self, filename):
+        """Stop cProfile and write its statistics to filename."""
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(filename)
+
+    def report(self):
+        wall = time.monotonic() - self.start
+        lines = [f"Profile: {wall:.3f} s in total, phases summed over threads:"]
+        with self.lock:
+            phases = sorted(self.times.items(), key=lambda item: -item[1])
+            for name, seconds in phases:
+                lines.append(
+                    "  {:<16}{:10.3f} s {:6.1f} % {:8d} x".format(
+                        name,
+                        seconds,
+                        100 * seconds / max(wall, 1e-9),
+                        self.counts[name],
+                    )
+                )
+        return "\n".join(lines)
+
+
+@contextmanager
+def phase(session, name):
+    """Time a phase with the profiler of the session, if it has one."""
+    profiler = getattr(session, "profiler", None)
+    if profiler is None:
+        yield
+    else:
+        with profiler.phase(name):
+            yield
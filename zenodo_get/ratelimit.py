@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+import os
+import time
+import threading
+from collections import deque
+
+UNITS = {"": 1, "k": 2**10, "m": 2**20, "g": 2**30}
+
+
+def parse_size(value):
+    """Parse a size like '500k', '10M' or '1.5G' (bytes)."""
+    value = value.strip().lower()
+    if value.endswith("b"):
+        value = value[:-1]
+    number, unit = value, ""
+    if value and value[-1] in UNITS:
+        number, unit = value[:-1], value[-1]
+    return float(number) * UNITS[unit]
+
+
+def parse_rate(value):
+    """Parse a rate like '500k', '10M' or '1.5G' (bytes/s); 0 means unlimited."""
+    value = value.strip().lower()
+    if value.endswith("/s"):
+        value = value[:-2]
+    return parse_size(value)
+
+
+class RateLimiter:
+    """Token bucket shared by every transfer of the process.
+
+    Transfers draw tokens for each chunk they receive. Waiting transfers are
+    served strictly in arrival order, and each waits for one chunk at a
+    time, so the bandwidth is shared round-robin and small files are not
+    starved behind large archives. The rate can be changed at any time with
+    set_rate(); a rate of 0 or None disables the limit.
+    """
+
+    def __init__(self, rate=None, burst=1.0):
+        self.rate = rate or 0
+        self.burst = burst
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.queue = deque()
+        self.cond = threading.Condition()
+
+    def set_rate(self, rate):
+        with self.cond:
+            self.refill()
+            self.rate = rate or 0
+            self.cond.notify_all()
+
+    def chunk_size(self, default):
+        """Chunk size to use with the current rate: about 10 chunks per second."""
+        if not self.rate:
+            return default
+        return int(min(default, max(self.rate / 10, 2**14)))
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate:
+            capacity = self.rate * self.burst
+            self.tokens = min(capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, n):
+        """Block until n bytes may be transferred."""
+        if not self.rate or n <= 0:
+            return
+        ticket = object()
+        with self.cond:
+            self.queue.append(ticket)
+            try:
+                while True:
+                    if not self.rate:
+                        return
+                    if self.queue[0] is ticket:
+                        self.refill()
+                        if self.tokens > 0:
+                            # a chunk larger than the bucket leaves a debt
+                            self.tokens -= n
+                            return
+                        self.cond.wait(-self.tokens / self.rate + 0.001)
+                    else:
+                        self.cond.wait()
+            finally:
+                self.queue.remove(ticket)
+                self.cond.notify_all()
+
+
+class RateFile(threading.Thread):
+    """Reload the rate of a limiter whenever the given file is modified."""
+
+    def __init__(self, limiter, filename, interval=1.0):
+        super().__init__(daemon=True)
+        self.limiter = limiter
+        self.filename = os.path.abspath(filename)
+        self.interval = interval
+        self.mtime = None
+        self.reload()
+
+    def reload(self):
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+            if mtime != self.mtime:
+                self.mtime = mtime
+                with open(self.filename, "rt") as f:
+                    self.limiter.set_rate(parse_rate(f.read() or "0"))
+        except (OSError, ValueError):
+            pass
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.reload()
+
+
+class ConcurrencyController:
+    """Adaptive limit for the number of connections in flight (AIMD).
+
+    The limit grows by one while the aggregate throughput keeps rising and
+    all slots are busy, it is halved when the server pushes back with
+    HTTP 429/503, and it is reduced by a quarter when the time to the
+    response headers rises well above the best observed value.
+    """
+
+    def __init__(self, maximum, initial=2, interval=2.0):
+        self.maximum = max(maximum, 1)
+        self.limit = min(initial, self.maximum)
+        self.interval = interval
+        self.inflight = 0
+        self.cond = threading.Condition()
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.last_rate = 0.0
+        self.saturated = False
+        self.best_latency = None
+        self.latency = None
+        self.cooldown = 0.0
+        self.history = [self.limit]
+        self.backoffs = {"pushback": 0, "latency": 0}
+
+    def acquire(self):
+        with self.cond:
+            while self.inflight >= self.limit:
+                self.saturated = True
+                self.cond.wait()
+            self.inflight += 1
+            if self.inflight >= self.limit:
+                self.saturated = True
+
+    def release(self):
+        with self.cond:
+            self.inflight -= 1
+            self.cond.notify_all()
+
+    def set_limit(self, limit):
+        limit = min(max(int(limit), 1), self.maximum)
+        if limit != self.limit:
+            self.limit = limit
+            self.history.append(limit)
+            self.cond.notify_all()
+
+    def record(self, nbytes):
+        """Account received bytes, and adjust the limit once per interval."""
+        with self.cond:
+            self.window_bytes += nbytes
+            now = time.monotonic()
+            elapsed = now - self.window_start
+            if elapsed < self.interval:
+                return
+            rate = self.window_bytes / elapsed
+            if rate > self.last_rate * 1.05 and self.saturated:
+                self.set_limit(self.limit + 1)
+            elif rate < self.last_rate * 0.8 and self.saturated and now > self.cooldown:
+                self.set_limit(self.limit - 1)
+            self.last_rate = rate
+            self.window_start = now
+            self.window_bytes = 0
+            self.saturated = self.inflight >= self.limit
+
+    def observe_latency(self, seconds):
+        with self.cond:
+            if self.best_latency is None or seconds < self.best_latency:
+                self.best_latency = seconds
+            if self.latency is None:
+                self.latency = seconds
+            self.latency = 0.8 * self.latency + 0.2 * seconds
+            now = time.monotonic()
+            if self.latency > 3 * self.best_latency + 0.05 and now > self.cooldown:
+                self.backoffs["latency"] += 1
+                self.set_limit(self.limit * 3 // 4)
+                self.latency = self.best_latency
+                self.cooldown = now + self.interval
+
+    def pushback(self):
+        """The server answered 429 or 503: halve the limit."""
+        with self.cond:
+            now = time.monotonic()
+            if now > self.cooldown:
+                self.backoffs["pushback"] += 1
+                self.set_limit(self.limit // 2)
+                self.cooldown = now + self.interval
+
+    def summary(self):
+        return (
+            "Connections: started with {}, peak {}, final {} (max {}); "
+            "{} server pushbacks, {} latency backoffs.".format(
+                self.history[0],
+                max(self.history),
+                self.limit,
+                self.maximum,
+                self.backoffs["pushback"],
+                self.backoffs["latency"],
+            )
+        )
@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+"""Zip archives over HTTP.
+
+The central directory is at the end of a zip file: it is fetched with one
+small Range request for the tail of the archive. Single members can then be
+read with one Range request covering their local header and compressed
+data (extract_members), or the whole archive can be decompressed while it
+is being downloaded (Extractor).
+"""
+
+import io
+import os
+import bz2
+import zlib
+import struct
+import fnmatch
+import zipfile
+from zenodo_get import retry
+from zenodo_get.retry import TransferError, ChecksumError
+
+TAIL_SIZE = 2**16 + 22
+
+
+class RangeFile(io.RawIOBase):
+    """Seekable, read-only view of a remote file based on Range requests.
+
+    Sequential reads are served from one streamed response, which covers
+    the bytes up to limit; a seek elsewhere starts a new request. Transient
+    errors are retried from the current position.
+    """
+
+    def __init__(
+        self,
+        session,
+        url,
+        size,
+        params=None,
+        timeout=15.0,
+        retries=0,
+        pause=0.5,
+        abort=None,
+    ):
+        super().__init__()
+        self.abort = abort
+        self.session = session
+        self.url = url
+        self.size = size
+        self.params = params
+        self.timeout = timeout
+        self.policy = retry.RetryPolicy(retries, pause)
+        self.pos = 0
+        self.limit = size
+        self.response = None
+        self.stream_pos = None
+        self.stream_end = None
+        self.etag = None
+        self.tail = b""
+        self.tail_start = size
+        self.transferred = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def get(self, headers):
+        if self.etag:
+            headers["If-Range"] = self.etag
+        r = self.session.get(
+            self.url,
+            params=self.params,
+            headers=headers,
+            stream=True,
+            timeout=self.timeout,
+        )
+        if r.status_code != 206:
+            r.close()
+            if r.status_code in retry.TRANSIENT_STATUS:
+                r.raise_for_status()
+            raise IOError(f"Range request is not honoured: {r.status_code}")
+        total = r.headers.get("Content-Range", "").rpartition("/")[2]
+        if total != str(self.size):
+            r.close()
+            raise IOError(f"Remote size has changed: {total} != {self.size}")
+        if self.etag is None:
+            self.etag = r.headers.get("ETag")
+        return r
+
+    def fetch_tail(self, n=TAIL_SIZE):
+        """Fetch the last n bytes, which usually hold the central directory."""
+        n = min(n, self.size)
+        if n <= 0:
+            return
+        with self.get({"Range": f"bytes=-{n}"}) as r:
+            self.tail = r.content
+        self.tail_start = self.size - len(self.tail)
+        self.transferred += len(self.tail)
+
+    def close_stream(self):
+        if self.response is not None:
+            self.response.close()
+        self.response = None
+        self.stream_pos = None
+
+    def read_stream(self, n):
+        if (
+            self.response is None
+            or self.stream_pos != self.pos
+            or self.pos >= self.stream_end
+        ):
+            self.close_stream()
+            if self.pos >= self.limit:
+                self.limit = self.size
+            self.response = self.get({"Range": f"bytes={self.pos}-{self.limit - 1}"})
+            self.stream_pos = self.pos
+            self.stream_end = self.limit
+        data = self.response.raw.read(min(n, self.stream_end - self.pos))
+        if not data:
+            raise TransferError(f"Incomplete transfer at {self.pos} of {self.url}")
+        return data
+
+    def readinto(self, b):
+        n = min(len(b), self.size - self.pos)
+        if n <= 0:
+            return 0
+        if self.abort is not None and self.abort():
+            raise Exception("Immediate abort")
+        if self.pos >= self.tail_start:
+            data = self.tail[self.pos - self.tail_start :][:n]
+        else:
+            n = min(n, self.tail_start - self.pos)
+            attempt = 0
+            while True:
+                try:
+                    data = self.read_stream(n)
+                    self.stream_pos = self.pos + len(data)
+                    break
+                except Exception as e:
+                    self.close_stream()
+                    if not self.policy.should_retry(attempt, e):
+                        raise
+                    self.policy.sleep(self.policy.delay(attempt, e))
+                    attempt += 1
+            self.transferred += len(data)
+            limiter = getattr(self.session, "limiter", None)
+            if limiter is not None:
+                limiter.acquire(len(data))
+        b[: len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def close(self):
+        self.close_stream()
+        super().close()
+
+
+def crc32(filename):
+    crc = 0
+    with open(filename, "rb") as f:
+        while True:
+            data = f.read(2**20)
+            if not data:
+                return crc
+            crc = zlib.crc32(data, crc)
+
+
+def member_path(dest, name):
+    """Path of a zip member below dest, without absolute or '..' components."""
+    parts = name.replace("\\", "/").split("/")
+    return os.path.join(dest, *[p for p in parts if p not in ("", ".", "..")])
+
+
+def is_extracted(path, info):
+    return (
+        os.path.isfile(path)
+        and os.path.getsize(path) == info.file_size
+        and crc32(path) == info.CRC
+    )
+
+
+def select_members(infos, patterns):
+    return [
+        info
+        for info in infos
+        if not info.is_dir()
+        and any(fnmatch.fnmatchcase(info.filename, p) for p in patterns)
+    ]
+
+
+def read_directory(
+    session, url, size, params=None, timeout=15.0, retries=0, pause=0.5, abort=None
+):
+    """Return the ZipInfo entries of a remote zip and the bytes transferred."""
+    with RangeFile(session, url, size, params, timeout, retries, pause, abort) as fp:
+        fp.fetch_tail()
+        with zipfile.ZipFile(fp) as zf:
+            return zf.infolist(), fp.transferred
+
+
+def decompressor(info):
+    if info.flag_bits & 0x1:
+        raise NotImplementedError(f"Encrypted zip member: {info.filename}")
+    if info.compress_type == zipfile.ZIP_STORED:
+        return None
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        return zlib.decompressobj(-15)
+    if info.compress_type == zipfile.ZIP_BZIP2:
+        return bz2.BZ2Decompressor()
+    raise NotImplementedError(
+        f"Unsupported compression method {info.compress_type}: {info.filename}"
+    )
+
+
+class Extractor:
+    """Extract zip members from the bytes of the archive, fed in order.
+
+    The offsets and sizes of the members come from the central directory,
+    so the archive can be decompressed while it is downloaded. Every member
+    is written to 'name.part' and renamed once its size and CRC are
+    verified. Members which are already extracted are skipped without
+    decompressing them. reset() restarts from the first byte.
+    """
+
+    def __init__(self, infos, patterns, dest, log=None):
+        self.infos = sorted(
+            select_members(infos, patterns), key=lambda i: i.header_offset
+        )
+        self.dest = dest
+        self.log = log or (lambda *args: None)
+        self.output = None
+        # members found extracted by pending(), not to be read again
+        self.done = set()
+        self.reset()
+
+    def reset(self):
+        if self.output is not None:
+            self.output.close()
+        self.output = None
+        self.pos = 0
+        self.index = 0
+        self.state = "skip"
+        self.header = bytearray()
+        self.remaining = 0
+        self.extracted = []
+
+    def pending(self):
+        result = []
+        for info in self.infos:
+            if is_extracted(member_path(self.dest, info.filename), info):
+                self.done.add(info.filename)
+            else:
+                result.append(info)
+        return result
+
+    def header_size(self):
+        if len(self.header) < 30:
+            return 30
+        if self.header[:4] != b"PK\x03\x04":
+            raise zipfile.BadZipFile(f"Bad local file header at {self.pos}")
+        name_length, extra_length = struct.unpack("<HH", self.header[26:30])
+        return 30 + name_length + extra_length
+
+    def start_member(self, info):
+        self.remaining = info.compress_size
+        self.path = member_path(self.dest, info.filename)
+        if info.filename in self.done or is_extracted(self.path, info):
+            self.log(f"{self.path} is already extracted correctly.")
+            self.state = "discard"
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.output = open(self.path + ".part", "wb")
+        self.decompressor = decompressor(info)
+        self.crc = 0
+        self.state = "data"
+
+    def write(self, data):
+        self.output.write(data)
+        self.crc = zlib.crc32(data, self.crc)
+
+    def finish_member(self, info):
+        if self.state == "data":
+            if self.decompressor is not None and hasattr(self.decompressor, "flush"):
+                self.write(self.decompressor.flush())
+            size = self.output.tell()
+            self.output.close()
+            self.output = None
+            if size != info.file_size or self.crc != info.CRC:
+                os.remove(self.path + ".part")
+                raise ChecksumError(
+                    self.path, f"crc32:{info.CRC:08x}", f"crc32:{self.crc:08x}"
+                )
+            os.replace(self.path + ".part", self.path)
+            self.log(
+                "Extracted {} ({:.1f} MB)".format(self.path, info.file_size / 2**20)
+            )
+        self.extracted.append(info.filename)
+        self.index += 1
+        self.state = "skip"
+
+    def update(self, data):
+        view = memoryview(data)
+        while len(view):
+            if self.index >= len(self.infos):
+                self.pos += len(view)
+                return
+            info = self.infos[self.index]
+            if self.state == "skip":
+                n = min(len(view), info.header_offset - self.pos)
+                if self.pos + n == info.header_offset:
+                    self.state = "header"
+                    self.header = bytearray()
+            elif self.state == "header":
+                n = min(len(view), self.header_size() - len(self.header))
+                self.header += view[:n]
+                if len(self.header) == self.header_size():
+                    self.start_member(info)
+            else:
+                n = min(len(view), self.remaining)
+                if self.state == "data":
+                    chunk = view[:n]
+                    if self.decompressor is not None:
+                        try:
+                            chunk = self.decompressor.decompress(chunk)
+                        except (zlib.error, OSError, EOFError) as e:
+                            raise ChecksumError(self.path, info.CRC, e)
+                    self.write(chunk)
+                self.remaining -= n
+            view = view[n:]
+            self.pos += n
+            if self.state in ("data", "discard") and self.remaining == 0:
+                self.finish_member(info)
+
+    def finish(self):
+        """Check that every selected member has been extracted."""
+        if self.index < len(self.infos):
+            raise zipfile.BadZipFile(
+                f"Archive ended before {self.infos[self.index].filename}"
+            )
+        return self.extracted
+
+
+def extract_file(filename, patterns, dest, log=None):
+    """Extract the members of a local zip file with an Extractor.
+
+    Returns the names of the extracted members. The archive is not read
+    if all of them are already extracted.
+    """
+    with zipfile.ZipFile(filename) as zf:
+        extractor = Extractor(zf.infolist(), patterns, dest, log)
+    if not extractor.pending():
+        extractor.log(f"{filename} is already extracted correctly.")
+        return [info.filename for info in extractor.infos]
+    with open(filename, "rb") as f:
+        while True:
+            data = f.read(2**20)
+            if not data:
+                break
+            extractor.update(data)
+    return extractor.finish()
+
+
+def extract_members(
+    session,
+    url,
+    size,
+    patterns,
+    dest,
+    params=None,
+    timeout=15.0,
+    retries=0,
+    pause=0.5,
+    abort=None,
+    log=None,
+):
+    """Extract the members of the remote zip at url which match any of the
+    glob patterns into the directory dest.
+
+    Members already present with the right size and CRC are skipped. The
+    CRC of every extracted member is checked by zipfile.
+
+    Returns the names of the matching members and the number of bytes
+    transferred.
+    """
+    log = log or (lambda *args: None)
+    with RangeFile(session, url, size, params, timeout, retries, pause, abort) as fp:
+        fp.fetch_tail()
+        with zipfile.ZipFile(fp) as zf:
+            infos = zf.infolist()
+            # a member ends where the next one (or the central directory) starts
+            offsets = sorted({i.header_offset for i in infos} | {zf.start_dir})
+            names = []
+            for info in select_members(infos, patterns):
+                names.append(info.filename)
+                target = member_path(dest, info.filename)
+                if is_extracted(target, info):
+                    log(f"{target} is already extracted correctly.")
+                    continue
+                fp.limit = offsets[offsets.index(info.header_offset) + 1]
+                path = zf.extract(info, dest)
+                log("Extracted {} ({:.1f} MB)".format(path, info.file_size / 2**20))
+    return names, fp.transferred
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+import time
+import random
+import requests
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+TRANSIENT_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+class TransferError(IOError):
+    """A transfer ended prematurely or inconsistently; worth another try."""
+
+
+class ChecksumError(Exception):
+    def __init__(self, filename, expected, actual):
+        super().__init__(f"checksum mismatch: {filename} ({expected} got:{actual})")
+        self.filename = filename
+        self.expected = expected
+        self.actual = actual
+
+
+def is_transient(exc):
+    """Classify an exception raised by a transfer as transient or fatal."""
+    if isinstance(exc, (TransferError, ChecksumError)):
+        return True
+    if isinstance(exc, requests.exceptions.HTTPError):
+        return exc.response is not None and (
+            exc.response.status_code in TRANSIENT_STATUS
+        )
+    if isinstance(
+        exc,
+        (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.ContentDecodingError,
+        ),
+    ):
+        return True
+    return False
+
+
+def retry_after(exc):
+    """Seconds requested by a Retry-After header of the failed response."""
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, honouring Retry-After.
+
+    The n-th retry waits a random time between pause and
+    min(max_pause, pause * 2**n), unless the server asked for a specific
+    delay with Retry-After.
+    """
+
+    def __init__(self, retries, pause=0.5, max_pause=60.0, max_retry_after=600.0):
+        self.retries = retries
+        self.pause = pause
+        self.max_pause = max_pause
+        self.max_retry_after = max_retry_after
+
+    def should_retry(self, attempt, exc):
+        return attempt < self.retries and is_transient(exc)
+
+    def delay(self, attempt, exc=None):
+        requested = retry_after(exc)
+        if requested is not None:
+            return min(requested, self.max_retry_after)
+        ceiling = min(self.max_pause, self.pause * 2**attempt)
+        return random.uniform(min(self.pause, ceiling), ceiling)
+
+    @staticmethod
+    def sleep(seconds, abort=None):
+        """Sleep, but wake up early if abort() becomes true."""
+        deadline = time.monotonic() + seconds
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or (abort is not None and abort()):
+                return
+            time.sleep(min(remaining, 0.25))
@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+import os
+import hashlib
+import sys
+import json
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from zenodo_get.retry import TransferError
+from zenodo_get.events import emit, throughput
+from zenodo_get.profiler import phase
+
+CHUNK_SIZE = 2**20
+COMMIT_INTERVAL = 16 * 2**20
+
+
+def make_session(pool_size=10, limiter=None):
+    """Create a keep-alive HTTP session with room for pool_size connections
+    per host, so concurrent transfers reuse connections instead of opening
+    a new TLS session for every file.
+
+    If a RateLimiter is given, every response body read through the
+    session draws from it: metadata responses when they arrive, streamed
+    downloads chunk by chunk.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(pool_size, 1))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.limiter = limiter
+    if limiter is not None:
+
+        def throttle(r, *args, **kwargs):
+            if not kwargs.get("stream"):
+                limiter.acquire(len(r.content))
+
+        session.hooks["response"].append(throttle)
+    return session
+
+
+def progress_bar(current, total, width=50):
+    if total:
+        done = int(width * current / total)
+        line = "[{}{}] {:.1f} / {:.1f} MB".format(
+            "." * done, " " * (width - done), current / 2**20, total / 2**20
+        )
+    else:
+        line = "{:.1f} MB".format(current / 2**20)
+    print("\r" + line, end="", file=sys.stderr, flush=True)
+
+
+def probe(session, url, params=None, timeout=15.0):
+    """Return (size, accepts_ranges, etag) of the remote resource."""
+    r = session.head(url, params=params, timeout=timeout, allow_redirects=True)
+    r.raise_for_status()
+    try:
+        size = int(r.headers["Content-Length"])
+    except (KeyError, ValueError):
+        size = None
+    accepts_ranges = r.headers.get("Accept-Ranges", "").lower() == "bytes"
+    return size, accepts_ranges, r.headers.get("ETag")
+
+
+def split_ranges(size, segments):
+    step = max(-(-size // segments), 1)
+    return [
+        [start, min(start + step, size) - 1, start] for start in range(0, size, step)
+    ]
+
+
+class PartFile:
+    """An incomplete download: 'name.part' and its 'name.part.json' state.
+
+    The part file is preallocated to the final size, the state records the
+    byte ranges and how far each of them has been committed to disk, and
+    the identity (size, checksum, ETag) of the remote file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.part = filename + ".part"
+        self.statefile = self.part + ".json"
+        self.lock = threading.Lock()
+        self.state = None
+
+    def load(self, url, size, checksum):
+        """Load a previous state if it belongs to the same remote file."""
+        try:
+            with open(self.statefile, "rt") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (
+            state.get("url") != url
+            or state.get("size") != size
+            or state.get("checksum") != checksum
+            or not os.path.exists(self.part)
+            or os.path.getsize(self.part) != size
+        ):
+            return None
+        self.state = state
+        return state
+
+    def create(self, url, size, checksum, ranges, etag=None):
+        self.discard()
+        with open(self.part, "wb") as f:
+            f.truncate(size)
+        self.state = {
+            "url": url,
+            "size": size,
+            "checksum": checksum,
+            "etag": etag,
+            "ranges": ranges,
+        }
+        self.save()
+
+    def save(self):
+        with self.lock:
+            tmpfile = self.statefile + ".tmp"
+            with open(tmpfile, "wt") as f:
+                json.dump(self.state, f)
+            os.replace(tmpfile, self.statefile)
+
+    def commit(self, index, pos):
+        with self.lock:
+            self.state["ranges"][index][2] = pos
+        self.save()
+
+    def pending(self):
+        return [i for i, r in enumerate(self.state["ranges"]) if r[2] <= r[1]]
+
+    def received(self):
+        return sum(r[2] - r[0] for r in self.state["ranges"])
+
+    def finish(self):
+        os.replace(self.part, self.filename)
+        os.remove(self.statefile)
+
+    def discard(self):
+        for name in (self.part, self.statefile):
+            if os.path.exists(name):
+                os.remove(name)
+
+
+class StreamHasher:
+    """Compute the digest of a file from the bytes as they are written.
+
+    Byte ranges may arrive out of order. Data written at the current hash
+    offset is hashed directly; when the offset is inside a range that has
+    already been written (e.g. after resuming, or when an earlier segment
+    has just been completed), the missing part is read back from disk once.
+    So a file downloaded in N parallel segments is mostly read back: only
+    the data of one segment at a time can be hashed as it arrives.
+
+    The bytes can be passed on, in order, to a sink with update() and
+    reset() methods, e.g. a remotezip.Extractor.
+    """
+
+    def __init__(self, filename, algorithm="md5", sink=None):
+        self.filename = filename
+        self.algorithm = algorithm
+        self.sink = sink
+        self.hash = hashlib.new(algorithm)
+        self.offset = 0
+        self.lock = threading.Lock()
+        if sink is not None:
+            sink.reset()
+
+    def reset(self):
+        with self.lock:
+            self.hash = hashlib.new(self.algorithm)
+            self.offset = 0
+            if self.sink is not None:
+                self.sink.reset()
+
+    def feed(self, data):
+        self.hash.update(data)
+        if self.sink is not None:
+            self.sink.update(data)
+        self.offset += len(data)
+
+    def catch_up(self, offset):
+        with open(self.filename, "rb") as f:
+            f.seek(self.offset)
+            while self.offset < offset:
+                data = f.read(min(CHUNK_SIZE, offset - self.offset))
+                if not data:
+                    raise TransferError(f"Unexpected end of file: {self.filename}")
+                self.feed(data)
+
+    def update(self, offset, data, start, flush):
+        """Feed data written at offset by the writer of a range from start."""
+        with self.lock:
+            if start <= self.offset < offset:
+                flush()
+                self.catch_up(offset)
+            if self.offset == offset:
+                self.feed(data)
+
+    def hexdigest(self, size):
+        with self.lock:
+            self.catch_up(size)
+            return self.hash.hexdigest()
+
+
+def fetch_range(session, part, index, params, timeout, abort, counter, hasher):
+    """Fetch one byte range of the part file, starting at its committed offset.
+
+    If the session has a ConcurrencyController, the request waits for one
+    of its connection slots and reports latency, pushback and throughput.
+    """
+    controller = getattr(session, "controller", None)
+    if controller is None:
+        return transfer_range(
+            session, part, index, params, timeout, abort, counter, hasher, None
+        )
+    controller.acquire()
+    try:
+        return transfer_range(
+            session, part, index, params, timeout, abort, counter, hasher, controller
+        )
+    finally:
+        controller.release()
+
+
+def transfer_range(
+    session, part, index, params, timeout, abort, counter, hasher, controller
+):
+    state = part.state
+    start, end, pos = state["ranges"][index]
+    size = state["size"]
+    headers = {}
+    if pos > 0 or end < size - 1:
+        headers["Range"] = f"bytes={pos}-{end}"
+        if state.get("etag"):
+            headers["If-Range"] = state["etag"]
+
+    requested = time.monotonic()
+    with session.get(
+        state["url"], params=params, headers=headers, stream=True, timeout=timeout
+    ) as r:
+        emit(
+            session,
+            "response",
+            file=part.filename,
+            range=[pos, end],
+            status=r.status_code,
+            latency=round(r.elapsed.total_seconds(), 6),
+        )
+        if controller is not None:
+            if r.status_code in (429, 503):
+                controller.pushback()
+            else:
+                controller.observe_latency(r.elapsed.total_seconds())
+        r.raise_for_status()
+        if r.status_code == 206:
+            content_range = r.headers.get("Content-Range", "")
+            if content_range != f"bytes {pos}-{end}/{size}":
+                part.discard()
+                raise TransferError(f"Unexpected Content-Range: {content_range}")
+        elif len(state["ranges"]) == 1:
+            # range not honoured or the remote file has changed: start over
+            total = r.headers.get("Content-Length")
+            if total is not None and int(total) != size:
+                part.discard()
+                raise IOError(f"Remote size has changed: {total} != {size}")
+            counter(start - pos)
+            hasher.reset()
+            pos = start
+        else:
+            part.discard()
+            raise TransferError(f"Range request is not honoured: {r.status_code}")
+        if state.get("etag") is None and r.headers.get("ETag"):
+            state["etag"] = r.headers["ETag"]
+
+        committed = first = pos
+        with open(part.part, "r+b") as f:
+            f.seek(pos)
+            try:
+                limiter = getattr(session, "limiter", None)
+                chunk_size = CHUNK_SIZE
+                if limiter is not None:
+                    chunk_size = limiter.chunk_size(CHUNK_SIZE)
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    if limiter is not None:
+                        limiter.acquire(len(chunk))
+                    if controller is not None:
+                        controller.record(len(chunk))
+                    if abort():
+                        raise Exception("Immediate abort")
+                    chunk = chunk[: end + 1 - pos]
+                    if pos == first:
+                        emit(
+                            session,
+                            "first_byte",
+                            file=part.filename,
+                            offset=pos,
+                            latency=round(time.monotonic() - requested, 6),
+                        )
+                    f.write(chunk)
+                    hasher.update(pos, chunk, start, f.flush)
+                    pos += len(chunk)
+                    counter(len(chunk))
+                    if pos - committed >= COMMIT_INTERVAL:
+                        with phase(session, "fs"):
+                            f.flush()
+                            part.commit(index, pos)
+                        committed = pos
+            finally:
+                with phase(session, "fs"):
+                    f.flush()
+                    part.commit(index, pos)
+                duration = time.monotonic() - requested
+                emit(
+                    session,
+                    "range",
+                    file=part.filename,
+                    range=[first, end],
+                    bytes=pos - first,
+                    duration=round(duration, 6),
+                    throughput=throughput(pos - first, duration),
+                    complete=pos == end + 1,
+                )
+        if pos != end + 1:
+            raise TransferError(f"Incomplete transfer: {pos} of {start}-{end}")
+
+
+def download(
+    session,
+    url,
+    filename,
+    size,
+    checksum=None,
+    segments=1,
+    resume=True,
+    params=None,
+    timeout=15.0,
+    algorithm="md5",
+    abort=None,
+    progress=None,
+    sink=None,
+    store=True,
+):
+    """Download url into filename, resuming an earlier attempt if possible.
+
+    The data is written into 'filename.part', which is renamed to filename
+    once complete. An interrupted transfer leaves the part file and its
+    state behind; the next call continues from the last committed offset
+    if the remote size and checksum are still the same. With segments > 1
+    the missing ranges are fetched over parallel connections, provided the
+    server advertises Accept-Ranges.
+
+    The digest is computed while the data is written, so the file does not
+    have to be read again for verification. The data is also passed to
+    sink in order, if given. With store=False nothing is written to disk:
+    the data only goes to sink, see stream().
+
+    Returns the number of bytes transferred and the hex digest of the file.
+    """
+    if not store:
+        return stream(
+            session, url, size, sink, params, timeout, algorithm, abort, progress
+        )
+    part = PartFile(filename)
+    state = part.load(url, size, checksum) if resume else None
+    if state is None:
+        ranges = [[0, size - 1, 0]]
+        etag = None
+        if segments > 1 and size > 0:
+            remote_size, accepts_ranges, etag = probe(session, url, params, timeout)
+            if remote_size is not None and remote_size != size:
+                raise IOError(f"Remote size has changed: {remote_size} != {size}")
+            if accepts_ranges and remote_size is not None:
+                ranges = split_ranges(size, segments)
+        with phase(session, "fs"):
+            part.create(url, size, checksum, ranges, etag)
+    hasher = StreamHasher(part.part, algorithm, sink)
+
+    failed = []
+    lock = threading.Lock()
+    received = [part.received()]
+    transferred = [0]
+
+    def stop():
+        return bool(failed) or (abort is not None and abort())
+
+    def counter(n):
+        with lock:
+            received[0] += n
+            transferred[0] += max(n, 0)
+            if progress is not None:
+                progress(received[0], size)
+
+    pending = part.pending()
+    if len(pending) == 1:
+        # a single range is fetched in this thread, without a pool
+        fetch_range(session, part, pending[0], params, timeout, stop, counter, hasher)
+    elif pending:
+        with ThreadPoolExecutor(max_workers=min(segments, len(pending))) as executor:
+            futures = [
+                executor.submit(
+                    fetch_range,
+                    session,
+                    part,
+                    index,
+                    params,
+                    timeout,
+                    stop,
+                    counter,
+                    hasher,
+                )
+                for index in pending
+            ]
+            for future in futures:
+                try:
+                    future.result()
+                except BaseException:
+                    failed.append(future)
+                    raise
+    with phase(session, "hash.catch_up"):
+        digest = hasher.hexdigest(size)
+    with phase(session, "fs"):
+        part.finish()
+    return transferred[0], digest
+
+
+def stream(
+    session,
+    url,
+    size,
+    sink,
+    params=None,
+    timeout=15.0,
+    algorithm="md5",
+    abort=None,
+    progress=None,
+):
+    """Download url without storing it: the data only goes to sink.
+
+    Nothing is left behind to resume from, so every call starts from the
+    first byte. Returns the number of bytes transferred and the hex digest.
+    """
+    h = hashlib.new(algorithm)
+    sink.reset()
+    received = 0
+    requested = time.monotonic()
+    with session.get(url, params=params, stream=True, timeout=timeout) as r:
+        emit(
+            session,
+            "response",
+            url=url,
+            range=[0, size - 1],
+            status=r.status_code,
+            latency=round(r.elapsed.total_seconds(), 6),
+        )
+        r.raise_for_status()
+        limiter = getattr(session, "limiter", None)
+        chunk_size = CHUNK_SIZE
+        if limiter is not None:
+            chunk_size = limiter.chunk_size(CHUNK_SIZE)
+        for chunk in r.iter_content(chunk_size=chunk_size):
+            if limiter is not None:
+                limiter.acquire(len(chunk))
+            if abort is not None and abort():
+                raise Exception("Immediate abort")
+            chunk = chunk[: size - received]
+            h.update(chunk)
+            sink.update(chunk)
+            received += len(chunk)
+            if progress is not None:
+                progress(received, size)
+    duration = time.monotonic() - requested
+    emit(
+        session,
+        "range",
+        url=url,
+        range=[0, size - 1],
+        bytes=received,
+        duration=round(duration, 6),
+        throughput=throughput(received, duration),
+        complete=received == size,
+    )
+    if received != size:
+        raise TransferError(f"Incomplete transfer: {received} of {size}")
+    return received, h.hexdigest()
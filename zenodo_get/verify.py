@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+BUFFER_SIZE = 8 * 2**20
+
+
+def parse_checksum(checksum):
+    """Split a Zenodo 'algorithm:value' checksum; plain values are MD5."""
+    algorithm, sep, value = checksum.strip().rpartition(":")
+    if not sep:
+        algorithm = "md5"
+    return algorithm.lower(), value.strip().lower()
+
+
+def file_digest(filename, algorithm="md5"):
+    """Hash a file with a large reusable buffer.
+
+    hashlib releases the GIL while it hashes large blocks, so several files
+    can be hashed on several cores from a thread pool.
+    """
+    h = hashlib.new(algorithm)
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(filename, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+def read_md5sums(filename):
+    """Read an md5sum(1) style file into (filename, checksum) pairs."""
+    entries = []
+    with open(filename, "rt") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            value, name = line.split(None, 1)
+            if name.startswith("*"):
+                name = name[1:]
+            entries.append((name, f"md5:{value}"))
+    return entries
+
+
+def verify_file(filename, checksum, hash_cache=None):
+    algorithm, expected = parse_checksum(checksum)
+    result = {
+        "file": filename,
+        "algorithm": algorithm,
+        "expected": expected,
+        "actual": None,
+    }
+    if not os.path.isfile(filename):
+        result["status"] = "missing"
+        return result
+    try:
+        result["actual"] = file_digest(filename, algorithm)
+    except (OSError, ValueError) as e:
+        result["status"] = "error"
+        result["error"] = str(e)
+        return result
+    if result["actual"] == expected:
+        result["status"] = "ok"
+        if hash_cache is not None:
+            hash_cache.put(filename, algorithm, expected)
+    else:
+        result["status"] = "mismatch"
+    return result
+
+
+def verify_files(entries, jobs=None, hash_cache=None):
+    """Verify (filename, checksum) pairs in parallel.
+
+    Yields one result dictionary per file, in the order of entries.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(verify_file, filename, checksum, hash_cache)
+            for filename, checksum in entries
+        ]
+        for future in futures:
+            yield future.result()
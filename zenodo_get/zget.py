@@ -1,16 +1,25 @@
 #!/usr/bin/env python3
 import zenodo_get as zget
+from zenodo_get import transfer
+from zenodo_get import cache
+from zenodo_get import verify
+from zenodo_get import ratelimit
+from zenodo_get import api
+from zenodo_get import remotezip
+from zenodo_get import events
+from zenodo_get import profiler
 import requests
-import hashlib
+import json
+import re
 import sys
 import os
 from optparse import OptionParser
-import wget
 import time
 import signal
+import threading
 from pathlib import Path
 from contextlib import contextmanager
-from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 # see https://stackoverflow.com/questions/431684/how-do-i-change-the-working-directory-in-python/24176022#24176022
@@ -28,9 +37,19 @@ def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
-def ctrl_c(func):
-    signal.signal(signal.SIGINT, func)
-    return func
+@contextmanager
+def profiling(session, options):
+    """Report the time spent in each phase (--profile) at the end of the run."""
+    if not options.profile and options.profile_dump is None:
+        yield
+        return
+    session.profiler = profiler.Profiler(cprofile=options.profile_dump is not None)
+    try:
+        yield
+    finally:
+        if options.profile_dump is not None:
+            session.profiler.dump(options.profile_dump)
+        eprint(session.profiler.report())
 
 
 abort_signal = False
@@ -38,7 +57,6 @@ abort_counter = 0
 exceptions = False
 
 
-@ctrl_c
 def handle_ctrl_c(*args, **kwargs):
     global abort_signal
     global abort_counter
@@ -56,23 +74,301 @@ def handle_ctrl_c(*args, **kwargs):
             sys.exit(1)
 
 
-def check_hash(filename, checksum):
-    algorithm = "md5"
-    value = checksum.strip()
-    if not os.path.exists(filename):
-        return value, "invalid"
-    h = hashlib.new(algorithm)
-    with open(filename, "rb") as f:
-        while True:
-            data = f.read(4096)
-            if not data:
+def immediate_abort():
+    return abort_counter >= 2
+
+
+def download_file(session, hash_cache, f, recordID, directory, options):
+    """Download and verify one entry of the record.
+
+    Returns the number of bytes transferred, 0 if nothing was fetched.
+    """
+    if abort_signal:
+        return 0
+
+    fname = f.get("filename") or f["key"]
+    link = api.file_url(recordID, fname, options.sandbox)
+
+    size = (f.get("filesize") or f["size"]) / 2**20
+    eprint()
+    eprint(f"Link: {link}   size: {size:.1f} MB")
+    extract = None
+    if options.extract:
+        if fname.lower().endswith(".zip"):
+            extract = options.members or ["*"]
+    elif options.members:
+        return extract_file(session, f, recordID, directory, options)
+
+    result = api.download_file(
+        session,
+        f,
+        recordID,
+        os.path.join(directory, fname),
+        access_token=options.access_token,
+        sandbox=options.sandbox,
+        resume=options.cont,
+        segments=options.segments,
+        segment_threshold=options.segment_threshold * 2**20,
+        retries=options.retry,
+        pause=options.pause,
+        timeout=options.timeout,
+        keep=options.keep,
+        paranoid=options.paranoid,
+        hash_cache=hash_cache,
+        abort=immediate_abort,
+        progress=transfer.progress_bar if options.jobs <= 1 else None,
+        log=eprint,
+        extract=extract,
+        keep_archive=not options.discard_zip,
+    )
+    if result["status"] in ("ok", "exists"):
+        return result["bytes"]
+
+    if result["status"] == "mismatch":
+        if not options.keep:
+            eprint("  File is deleted.")
+        else:
+            eprint("  File is NOT deleted!")
+        if not options.error:
+            sys.exit(1)
+        return result["bytes"]
+
+    eprint("  Too many errors." if result["status"] == "error" else "  Fatal error.")
+    if not options.error:
+        eprint("  Download is aborted.")
+        if exceptions:
+            raise Exception("too  many errors")
+        else:
+            sys.exit(1)
+    eprint("  Download continues with the next file.")
+    return result["bytes"]
+
+
+def extract_file(session, f, recordID, directory, options):
+    """Extract the members selected with --zip-member from a remote zip file.
+
+    Returns the number of bytes transferred.
+    """
+    fname = f.get("filename") or f["key"]
+    if not fname.lower().endswith(".zip"):
+        eprint(f"{fname} is not a zip archive, it is skipped.")
+        return 0
+
+    params = {}
+    if options.access_token:
+        params["access_token"] = options.access_token
+    try:
+        names, transferred = remotezip.extract_members(
+            session,
+            api.file_url(recordID, fname, options.sandbox),
+            f.get("filesize") or f["size"],
+            options.members,
+            directory,
+            params=params,
+            timeout=options.timeout,
+            retries=options.retry,
+            pause=options.pause,
+            abort=immediate_abort,
+            log=eprint,
+        )
+    except Exception as e:
+        if immediate_abort():
+            raise
+        eprint(f"  Extraction error: {e}")
+        if not options.error:
+            eprint("  Download is aborted.")
+            if exceptions:
+                raise
+            else:
+                sys.exit(1)
+        eprint("  Download continues with the next file.")
+        return 0
+    if not names:
+        eprint(f"  No member of {fname} matches.")
+    return transferred
+
+
+def download_files(session, hash_cache, tasks, options):
+    """Download (file, recordID, directory) tasks, using a pool of
+    options.jobs worker threads.
+
+    Returns the total number of bytes transferred.
+    """
+    if options.jobs <= 1:
+        total = 0
+        for task in tasks:
+            if abort_signal:
                 break
-            h.update(data)
-    digest = h.hexdigest()
-    return value, digest
+            total += download_file(session, hash_cache, *task, options)
+        return total
+
+    global abort_counter
+    total = 0
+    executor = ThreadPoolExecutor(max_workers=options.jobs)
+    futures = [
+        executor.submit(download_file, session, hash_cache, *task, options)
+        for task in tasks
+    ]
+    try:
+        for future in as_completed(futures):
+            total += future.result()
+    except BaseException:
+        # fatal error or second CTRL+C: stop the running transfers too
+        abort_counter = max(abort_counter, 2)
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+    return total
+
+
+def verify_entries(entries, hash_cache, options):
+    """Check (filename, checksum) pairs, one JSON line per file on stdout."""
+    failures = 0
+    jobs = options.jobs if options.jobs > 1 else None
+    try:
+        for result in verify.verify_files(entries, jobs, hash_cache):
+            print(json.dumps(result), flush=True)
+            if result["status"] != "ok":
+                failures += 1
+    finally:
+        if hash_cache is not None:
+            hash_cache.save()
+
+    eprint(f"{len(entries) - failures} of {len(entries)} files are correct.")
+    if failures:
+        if exceptions:
+            raise Exception("Verification failed.")
+        else:
+            sys.exit(1)
+
+
+def read_identifiers(filename):
+    """Read record IDs or DOIs, one per line, from a file or stdin ('-')."""
+    if filename == "-":
+        lines = sys.stdin.readlines()
+    else:
+        with open(filename, "rt") as f:
+            lines = f.readlines()
+    lines = [line.split("#")[0].strip() for line in lines]
+    return [line for line in lines if line]
+
+
+def get_record_id(session, doi_cache, identifier, options):
+    """Return the record ID for a record ID or DOI argument."""
+    try:
+        return api.record_id(
+            session, identifier, options.timeout, doi_cache, options.offline
+        )
+    except ValueError:
+        eprint("DOI could not be resolved. Try again, or use record ID.")
+        if exceptions:
+            raise
+        else:
+            sys.exit(1)
+    except requests.exceptions.ConnectTimeout:
+        eprint("Connection timeout.")
+        if exceptions:
+            raise
+        else:
+            sys.exit(1)
+    except Exception:
+        eprint("Connection error.")
+        if exceptions:
+            raise
+        else:
+            sys.exit(1)
+
+
+def get_metadata(session, metadata_cache, recordID, options):
+    """Return the metadata of a record as JSON."""
+    try:
+        return api.fetch_metadata(
+            session,
+            recordID,
+            access_token=options.access_token,
+            sandbox=options.sandbox,
+            timeout=options.timeout,
+            metadata_cache=metadata_cache,
+            offline=options.offline,
+        )
+    except ValueError:
+        eprint("Record could not get accessed.")
+        if exceptions:
+            raise
+        else:
+            sys.exit(1)
+    except requests.exceptions.ConnectTimeout:
+        eprint("Connection timeout during metadata reading.")
+        if exceptions:
+            raise
+        else:
+            sys.exit(1)
+    except Exception:
+        eprint("Connection error during metadata reading.")
+        if exceptions:
+            raise
+        else:
+            sys.exit(1)
+
+
+def get_record(session, doi_cache, metadata_cache, identifier, options):
+    recordID = get_record_id(session, doi_cache, identifier, options)
+    js = get_metadata(session, metadata_cache, recordID, options)
+    # a concept record ID resolves to its latest version
+    return str(js.get("id", recordID)), js
+
+
+def get_records(session, doi_cache, metadata_cache, identifiers, options):
+    """Resolve the identifiers and fetch the metadata of all records in parallel.
+
+    Returns (recordID, metadata) pairs in the order of identifiers. With
+    --continue-on-error records which cannot be accessed are skipped.
+    """
+    if len(identifiers) == 1:
+        return [get_record(session, doi_cache, metadata_cache, identifiers[0], options)]
+
+    records = []
+    with ThreadPoolExecutor(max_workers=min(len(identifiers), 16)) as executor:
+        futures = [
+            executor.submit(
+                get_record, session, doi_cache, metadata_cache, identifier, options
+            )
+            for identifier in identifiers
+        ]
+        for identifier, future in zip(identifiers, futures):
+            try:
+                records.append(future.result())
+            except (Exception, SystemExit):
+                if not options.error:
+                    for other in futures:
+                        other.cancel()
+                    raise
+                eprint(f"  {identifier} is skipped.")
+    return records
 
 
 def zenodo_get(argv=None):
+    """Run the command line interface; argv defaults to sys.argv[1:].
+
+    Ctrl+C is handled by zenodo_get only while it runs, and only if it is
+    called from the main thread.
+    """
+    global abort_signal
+    global abort_counter
+
+    abort_signal = False
+    abort_counter = 0
+    previous = None
+    if threading.current_thread() is threading.main_thread():
+        previous = signal.signal(signal.SIGINT, handle_ctrl_c)
+    try:
+        return main(argv)
+    finally:
+        if previous is not None:
+            signal.signal(signal.SIGINT, previous)
+
+
+def main(argv=None):
     global exceptions
 
     if argv is None:
@@ -82,7 +378,8 @@ def zenodo_get(argv=None):
         exceptions = True
 
     parser = OptionParser(
-        usage="%prog [options] RECORD_OR_DOI", version=f"%prog {zget.__version__}"
+        usage="%prog [options] RECORD_OR_DOI [RECORD_OR_DOI ...]",
+        version=f"%prog {zget.__version__}",
     )
 
     parser.add_option(
@@ -114,6 +411,17 @@ def zenodo_get(argv=None):
         default=None,
     )
 
+    parser.add_option(
+        "-i",
+        "--input-file",
+        action="store",
+        type="string",
+        dest="input",
+        help="Read record IDs or DOIs from FILE, one per line ('-': stdin). "
+        "Every record is downloaded into a subdirectory named after it.",
+        default=None,
+    )
+
     parser.add_option(
         "-m",
         "--md5",
@@ -124,6 +432,17 @@ def zenodo_get(argv=None):
         default=False,
     )
 
+    parser.add_option(
+        "-V",
+        "--verify",
+        action="store_true",
+        dest="verify",
+        help="Verify the files in the output directory against the record "
+        "checksums, or against md5sums.txt if no record is given. "
+        "(Files will not be downloaded.)",
+        default=False,
+    )
+
     parser.add_option(
         "-w",
         "--wget",
@@ -135,6 +454,85 @@ def zenodo_get(argv=None):
         default=None,
     )
 
+    parser.add_option(
+        "-g",
+        "--glob",
+        action="append",
+        type="string",
+        dest="include",
+        help="Select only files matching the glob PATTERN, e.g. 'IOT_2019_*.zip'. "
+        "Can be given several times. Applies to downloads, -w, -m and -V.",
+        default=[],
+    )
+
+    parser.add_option(
+        "--regex",
+        action="append",
+        type="string",
+        dest="regex",
+        help="Select only files matching the regular expression REGEX. "
+        "Can be given several times.",
+        default=[],
+    )
+
+    parser.add_option(
+        "-x",
+        "--exclude",
+        action="append",
+        type="string",
+        dest="exclude",
+        help="Skip files matching the glob PATTERN. Can be given several times.",
+        default=[],
+    )
+
+    parser.add_option(
+        "--min-size",
+        action="store",
+        type="string",
+        dest="min_size",
+        help="Skip files smaller than SIZE, e.g. 10M.",
+        default=None,
+    )
+
+    parser.add_option(
+        "--max-size",
+        action="store",
+        type="string",
+        dest="max_size",
+        help="Skip files larger than SIZE, e.g. 2G.",
+        default=None,
+    )
+
+    parser.add_option(
+        "-z",
+        "--zip-member",
+        action="append",
+        type="string",
+        dest="members",
+        help="Extract only the members matching the glob PATTERN from the zip "
+        "archives of the record, e.g. '*/satellite/F.txt', without downloading "
+        "the whole archives. Can be given several times.",
+        default=[],
+    )
+
+    parser.add_option(
+        "--extract",
+        action="store_true",
+        dest="extract",
+        help="Unpack the zip archives while they are downloaded (only the "
+        "members matching -z, if given).",
+        default=False,
+    )
+
+    parser.add_option(
+        "--discard-zip",
+        action="store_true",
+        dest="discard_zip",
+        help="With --extract: do not store the zip archives, only their "
+        "members. (Interrupted downloads start over.)",
+        default=False,
+    )
+
     parser.add_option(
         "-e",
         "--continue-on-error",
@@ -153,12 +551,22 @@ def zenodo_get(argv=None):
         default=False,
     )
 
+    parser.add_option(
+        "--paranoid",
+        action="store_true",
+        dest="paranoid",
+        help="Verify checksums by reading the downloaded files again "
+        "instead of hashing them while they are written.",
+        default=False,
+    )
+
     parser.add_option(
         "-n",
         "--do-not-continue",
         action="store_false",
         dest="cont",
-        help="Do not continue previous download attempt. (Default: continue.)",
+        help="Do not continue previous download attempt, "
+        "download everything from the beginning. (Default: continue.)",
         default=True,
     )
 
@@ -178,7 +586,8 @@ def zenodo_get(argv=None):
         action="store",
         type=float,
         dest="pause",
-        help="Wait N second before retry attempt, e.g. 0.5",
+        help="Wait at least N second before retry attempt, e.g. 0.5. "
+        "The wait grows exponentially with each further attempt.",
         default=0.5,
     )
 
@@ -192,6 +601,89 @@ def zenodo_get(argv=None):
         default=15.0,
     )
 
+    parser.add_option(
+        "-j",
+        "--jobs",
+        action="store",
+        type=int,
+        dest="jobs",
+        help="Download N files in parallel. Default: 1.",
+        default=1,
+    )
+
+    parser.add_option(
+        "--segments",
+        action="store",
+        type=int,
+        dest="segments",
+        help="Download large files over N parallel connections. Default: 1. "
+        "The checksum is computed while the first segment is written; the "
+        "other segments, (N-1)/N of the file, are read back from the disk.",
+        default=1,
+    )
+
+    parser.add_option(
+        "--segment-threshold",
+        action="store",
+        type=float,
+        dest="segment_threshold",
+        help="Minimum file size in MB for segmented download. Default: 64.",
+        default=64.0,
+    )
+
+    parser.add_option(
+        "--adaptive",
+        action="store_true",
+        dest="adaptive",
+        help="Adjust the number of parallel connections to the observed "
+        "throughput and server load, up to jobs x segments.",
+        default=False,
+    )
+
+    parser.add_option(
+        "--limit-rate",
+        action="store",
+        type=str,
+        dest="limit_rate",
+        help="Limit the total bandwidth of all transfers, e.g. 500k or 10M "
+        "[bytes/s]. With @FILE the rate is read from FILE, and it is reloaded "
+        "whenever the file changes.",
+        default=None,
+    )
+
+    parser.add_option(
+        "--events",
+        action="store",
+        type=str,
+        dest="events",
+        help="Append a JSON line to FILE for every phase of every transfer "
+        "(DOI resolution, metadata, responses, first byte, retries, checksums, "
+        "completion), with timestamps, bytes and throughput. "
+        "FILE - is the standard output.",
+        default=None,
+    )
+
+    parser.add_option(
+        "--profile",
+        action="store_true",
+        dest="profile",
+        help="Print the time spent in each phase of the run: DOI resolution, "
+        "metadata, hashing of existing files, transfer, verification, file "
+        "system operations.",
+        default=False,
+    )
+
+    parser.add_option(
+        "--profile-dump",
+        action="store",
+        type=str,
+        dest="profile_dump",
+        help="Like --profile, and write cProfile statistics of the main thread "
+        "to FILE (see pstats). The transfers run in the main thread, and are "
+        "included, with -j 1 and --segments 1 (the default).",
+        default=None,
+    )
+
     parser.add_option(
         "-o",
         "--output-dir",
@@ -202,6 +694,41 @@ def zenodo_get(argv=None):
         help="Output directory, created if necessary. Default: current directory.",
     )
 
+    parser.add_option(
+        "--cache-dir",
+        action="store",
+        type=str,
+        dest="cache_dir",
+        default=cache.cache_dir(),
+        help="Directory for cached checksums and metadata. Default: %default",
+    )
+
+    parser.add_option(
+        "--no-cache",
+        action="store_true",
+        dest="no_cache",
+        help="Do not use or update the cache.",
+        default=False,
+    )
+
+    parser.add_option(
+        "--metadata-ttl",
+        action="store",
+        type=float,
+        dest="metadata_ttl",
+        default=600.0,
+        help="Use cached record metadata without revalidation for N seconds. "
+        "Default: 600.",
+    )
+
+    parser.add_option(
+        "--offline",
+        action="store_true",
+        dest="offline",
+        help="Use only cached record metadata, e.g. with -w, -m or -V.",
+        default=False,
+    )
+
     parser.add_option(
         "-s",
         "--sandbox",
@@ -234,174 +761,185 @@ def zenodo_get(argv=None):
         else:
             sys.exit(0)
 
+    if options.discard_zip and not options.extract:
+        parser.error("--discard-zip requires --extract")
+    if options.events == "-" and (options.wget == "-" or options.verify):
+        parser.error("--events - would mix the events into the output of -w - and -V")
+
+    for name in ("min_size", "max_size"):
+        value = getattr(options, name)
+        if value is not None:
+            try:
+                setattr(options, name, ratelimit.parse_size(value))
+            except ValueError:
+                parser.error(f"invalid size: {value}")
+    for pattern in options.regex:
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            parser.error(f"invalid regular expression: {pattern} ({e})")
+
+    limiter = None
+    if options.limit_rate:
+        limiter = ratelimit.RateLimiter()
+        if options.limit_rate.startswith("@"):
+            ratelimit.RateFile(limiter, options.limit_rate[1:]).start()
+        else:
+            try:
+                limiter.set_rate(ratelimit.parse_rate(options.limit_rate))
+            except ValueError:
+                parser.error(f"invalid rate: {options.limit_rate}")
+
+    connections = options.jobs * max(options.segments, 1)
+    session = transfer.make_session(connections, limiter=limiter)
+    if options.adaptive:
+        session.controller = ratelimit.ConcurrencyController(connections)
+    if options.events:
+        session.events = events.EventLog(options.events)
+        events.emit(session, "start", version=zget.__version__, args=args)
+    hash_cache = None
+    metadata_cache = None
+    doi_cache = None
+    if not options.no_cache:
+        # the caches are saved after the change to the output directory
+        options.cache_dir = os.path.abspath(os.path.expanduser(options.cache_dir))
+        hash_cache = cache.HashCache(os.path.join(options.cache_dir, "hashes.json"))
+        metadata_cache = cache.MetadataCache(options.cache_dir, options.metadata_ttl)
+        doi_cache = cache.DOICache(options.cache_dir, options.metadata_ttl)
+    elif options.offline:
+        parser.error("--offline needs the cache")
+
+    identifiers = list(args)
+    if options.input is not None:
+        identifiers += read_identifiers(options.input)
+    if not identifiers and (options.record or options.doi):
+        identifiers = [options.record or options.doi]
+
     # create directory, if necessary, then change to it
     options.outdir = Path(options.outdir)
     options.outdir.mkdir(parents=True, exist_ok=True)
-    with cd(options.outdir):
-        if len(args) > 0:
-            try:
-                options.record = str(int(args[0]))
-            except ValueError:
-                options.doi = args[0]
-        elif options.doi is None and options.record is None:
-            parser.print_help()
-            if exceptions:
-                return
-            else:
-                sys.exit(0)
+    with profiling(session, options), cd(options.outdir):
 
-        if options.doi is not None:
-            url = options.doi
-            if not url.startswith("http"):
-                url = "https://doi.org/" + url
-            try:
-                r = requests.get(url, timeout=options.timeout)
-            except requests.exceptions.ConnectTimeout:
-                eprint("Connection timeout.")
+        if not identifiers and options.verify:
+            if not os.path.exists("md5sums.txt"):
+                eprint("No record is given and md5sums.txt is not found.")
                 if exceptions:
-                    raise
-                else:
-                    sys.exit(1)
-            except Exception:
-                eprint("Connection error.")
-                if exceptions:
-                    raise
-                else:
-                    sys.exit(1)
-            if not r.ok:
-                eprint("DOI could not be resolved. Try again, or use record ID.")
-                if exceptions:
-                    raise ValueError("DOI", options.doi)
+                    raise FileNotFoundError("md5sums.txt")
                 else:
                     sys.exit(1)
-
-            recordID = r.url.split("/")[-1]
-        else:
-            recordID = options.record
-        recordID = recordID.strip()
-
-        if not options.sandbox:
-            url = "https://zenodo.org/api/records/"
-        else:
-            url = "https://sandbox.zenodo.org/api/records/"
-
-        params = {}
-        if options.access_token:
-            params["access_token"] = options.access_token
-
-        try:
-            r = requests.get(url + recordID, params=params, timeout=options.timeout)
-        except requests.exceptions.ConnectTimeout:
-            eprint("Connection timeout during metadata reading.")
-            if exceptions:
-                raise
-            else:
-                sys.exit(1)
-        except Exception:
-            eprint("Connection error during metadata reading.")
+            with profiler.phase(session, "verify"):
+                verify_entries(verify.read_md5sums("md5sums.txt"), hash_cache, options)
+            return
+        elif not identifiers:
+            parser.print_help()
             if exceptions:
-                raise
+                return
             else:
-                sys.exit(1)
+                sys.exit(0)
 
-        if r.ok:
-            js = r.json()
-            files = js["files"]
+        # several records are downloaded into subdirectories named after them
+        batch = len(identifiers) > 1 or options.input is not None
+        records = get_records(session, doi_cache, metadata_cache, identifiers, options)
+
+        links = []
+        tasks = []
+        entries = []
+        for recordID, js in records:
+            directory = recordID if batch else ""
+            if batch:
+                os.makedirs(directory, exist_ok=True)
+            files = api.select_files(
+                js["files"],
+                options.include,
+                options.exclude,
+                options.regex,
+                options.min_size,
+                options.max_size,
+            )
             total_size = sum((f.get("filesize") or f["size"]) for f in files)
 
+            if options.verify:
+                entries += [
+                    (
+                        os.path.join(directory, f.get("filename") or f["key"]),
+                        f["checksum"],
+                    )
+                    for f in files
+                ]
+                continue
+
             if options.md5 is not None:
-                with open("md5sums.txt", "wt") as md5file:
+                with open(os.path.join(directory, "md5sums.txt"), "wt") as md5file:
                     for f in files:
                         fname = f.get("filename") or f["key"]
-                        checksum = f["checksum"].split(":")[-1]
+                        algorithm, checksum = verify.parse_checksum(f["checksum"])
+                        if algorithm != "md5":
+                            eprint(f"Not in md5sums.txt, {algorithm} checksum: {fname}")
+                            continue
                         md5file.write(f"{checksum}  {fname}\n")
 
             if options.wget is not None:
-                if options.wget == "-":
-                    for f in files:
-                        fname = f.get("filename") or f["key"]
-                        link = "https://zenodo.org/record/{}/files/{}".format(
-                            recordID, fname
-                        )
-                        print(link)
-                else:
-                    with open(options.wget, "wt") as wgetfile:
-                        for f in files:
-                            fname = f.get("filename") or f["key"]
-                            link = "https://zenodo.org/record/{}/files/{}".format(
-                                recordID, fname
-                            )
-                            wgetfile.write(link + "\n")
+                for f in files:
+                    fname = f.get("filename") or f["key"]
+                    links.append(api.file_url(recordID, fname, options.sandbox))
             else:
+                if batch:
+                    eprint()
+                    eprint(f"Record: {recordID}   directory: {directory}")
                 eprint("Title: {}".format(js["metadata"]["title"]))
                 eprint("Keywords: " + (", ".join(js["metadata"].get("keywords", []))))
                 eprint("Publication date: " + js["metadata"]["publication_date"])
                 eprint("DOI: " + js["metadata"]["doi"])
                 eprint("Total size: {:.1f} MB".format(total_size / 2**20))
+                if len(files) < len(js["files"]):
+                    eprint(f"Selected files: {len(files)} of {len(js['files'])}")
+                tasks += [(f, recordID, directory) for f in files]
 
-                for f in files:
-                    if abort_signal:
-                        eprint("Download aborted with CTRL+C.")
-                        eprint("Already successfully downloaded files are kept.")
-                        break
-
-                    fname = f.get("filename") or f["key"]
-                    link = "https://zenodo.org/record/{}/files/{}".format(
-                        recordID, fname
-                    )
+        if options.verify:
+            with profiler.phase(session, "verify"):
+                verify_entries(entries, hash_cache, options)
+            return
 
-                    size = (f.get("filesize") or f["size"]) / 2**20
-                    eprint()
-                    eprint(f"Link: {link}   size: {size:.1f} MB")
-                    fname = f.get("filename") or f["key"]
-                    checksum = f["checksum"].split(":")[-1]
-
-                    remote_hash, local_hash = check_hash(fname, checksum)
-
-                    if remote_hash == local_hash and options.cont:
-                        eprint(f"{fname} is already downloaded correctly.")
-                        continue
-
-                    for _ in range(options.retry + 1):
-                        try:
-                            link = url = unquote(link)
-                            filename = wget.download(
-                                f"{link}?access_token={options.access_token}"
-                            )
-                        except Exception:
-                            eprint(f"  Download error. Original link: {link}")
-                            time.sleep(options.pause)
-                        else:
-                            break
-                    else:
-                        eprint("  Too many errors.")
-                        if not options.error:
-                            eprint("  Download is aborted.")
-                            if exceptions:
-                                raise Exception("too  many errors")
-                            else:
-                                sys.exit(1)
-                        eprint("  Download continues with the next file.")
-                        continue
+        if options.wget is not None:
+            if options.wget == "-":
+                for link in links:
+                    print(link)
+            else:
+                with open(options.wget, "wt") as wgetfile:
+                    for link in links:
+                        wgetfile.write(link + "\n")
+            return
 
-                    eprint()
-                    h1, h2 = check_hash(filename, checksum)
-                    if h1 == h2:
-                        eprint(f"Checksum is correct. ({h1})")
-                    else:
-                        eprint(f"Checksum is INCORRECT!({h1} got:{h2})")
-                        if not options.keep:
-                            eprint("  File is deleted.")
-                            os.remove(filename)
-                        else:
-                            eprint("  File is NOT deleted!")
-                        if not options.error:
-                            sys.exit(1)
-                else:
-                    eprint("All files have been downloaded.")
+        start = time.time()
+        try:
+            transferred = download_files(session, hash_cache, tasks, options)
+        finally:
+            if hash_cache is not None:
+                with profiler.phase(session, "fs"):
+                    hash_cache.save()
+        elapsed = time.time() - start
+        events.emit(
+            session,
+            "finish",
+            files=len(tasks),
+            bytes=transferred,
+            duration=round(elapsed, 6),
+            throughput=events.throughput(transferred, elapsed),
+            aborted=abort_signal,
+        )
+
+        if abort_signal:
+            eprint("Download aborted with CTRL+C.")
+            eprint("Already successfully downloaded files are kept.")
         else:
-            eprint("Record could not get accessed.")
-            if exceptions:
-                raise Exception("Record could not get accessed.")
-            else:
-                sys.exit(1)
+            eprint("All files have been downloaded.")
+        if transferred > 0:
+            eprint(
+                "Transferred {:.1f} MB in {:.1f} s ({:.2f} MB/s).".format(
+                    transferred / 2**20,
+                    elapsed,
+                    transferred / 2**20 / max(elapsed, 1e-6),
+                )
+            )
+        if options.adaptive:
+            eprint(session.controller.summary())
@@ -1,106 +1,261 @@
 #!/usr/bin/env python3
 
 from time import time
-import json
 
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 from functools import lru_cache as cache
 import logging
 from stat import S_IFREG, S_IFDIR
 import sys
+import threading
 
 try:
     import requests
     from box import SBox
     from fuse import FUSE, Operations, LoggingMixIn
+    from zenodo_get.cache import MetadataCache, BlockCache, cache_dir
 except ImportError as e:
     logging.getLogger().critical(e)
-    logging.getLogger().critical('You need to install python-box, requests and fusepy.')
+    logging.getLogger().critical('You need to install python-box, requests, fusepy and zenodo_get.')
     sys.exit(1)
 
 
-class WebFile:
+def runs(indices, limit=None):
+    """Split sorted block indices into runs of consecutive ones, of at most limit blocks."""
+    run = []
+    for i in indices:
+        if run and (i != run[-1] + 1 or len(run) == limit):
+            yield run
+            run = []
+        run.append(i)
+    if run:
+        yield run
+
 
-    def __init__(self, url, size, chunksize=64, largefile=1024):
+class WebFile:
+    """Remote file read in aligned blocks of chunksize KB with Range requests.
+
+    The blocks are kept in an LRU cache of cache_size MB, and the missing
+    blocks of one read are fetched with a single request, so a read costs
+    the same wherever it lands in the file. Files smaller than largefile KB
+    are fetched at once. With disk, a CachedFile of the on-disk block cache,
+    blocks are looked up there before they are fetched, and stored there.
+    prefetch() fetches blocks in the background with executor; a read of a
+    block on its way waits for it instead of fetching it again.
+    """
+
+    def __init__(self, url, size, chunksize=64, largefile=1024, session=None, cache_size=64, timeout=15,
+                 disk=None, executor=None):
         self.url = url
-        self.r = None
+        self.size = size
+        self.session = session or requests.Session()
+        self.timeout = timeout
+        self.disk = disk
+        self.executor = executor
+        self.blocksize = chunksize * 1024
+        self.max_blocks = max(cache_size * 1024 // chunksize, 1)
+        # background requests of up to 1 MB, so that several run at once
+        self.request_blocks = max(1024 // chunksize, 1)
+        self.blocks = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.etag = None
         self.content = None
         if url is not None and size < (largefile * 1024):
-            with requests.get(url, stream=False) as r:
-                self.content = r.content
-        self.chunksize = 64
-        self.last_page = bytearray()
-        self.last_offset = 0
-        self.iterator = None
-
-    def reset(self):
-        self.last_offset = 0
-        self.r = requests.get(self.url, stream=True)
-        self.iterator = self.r.iter_content(chunk_size=self.chunksize * 1024)
+            if disk is not None and disk.complete():
+                self.content = b''.join(disk.get(i) for i in range(disk.nblocks))
+            else:
+                with self.session.get(url, stream=False, timeout=timeout) as r:
+                    r.raise_for_status()
+                    self.content = r.content
+                if disk is not None and len(self.content) == size:
+                    for i in range(disk.nblocks):
+                        disk.put(i, self.content[i * disk.blocksize:(i + 1) * disk.blocksize])
 
     def close(self):
-        self.last_offset = 0
-        self.last_page = bytearray()
-        self.r = None
-        self.iterator = None
-
-    def read_next(self):
+        with self.lock:
+            futures = set(self.pending.values())
+        for future in futures:
+            future.cancel()
+        wait(futures)
+        self.blocks.clear()
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
+
+    def store(self, index, block):
+        with self.lock:
+            self.blocks[index] = block
+            self.blocks.move_to_end(index)
+            while len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+
+    def fetch(self, first, last):
+        """Fetch the blocks first to last with one Range request."""
+        start = first * self.blocksize
+        end = min((last + 1) * self.blocksize, self.size) - 1
+        headers = {'Range': f'bytes={start}-{end}'}
+        if self.etag:
+            headers['If-Range'] = self.etag
+        with self.session.get(self.url, headers=headers, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            if r.status_code == 206:
+                total = r.headers.get('Content-Range', '').rpartition('/')[2]
+                if total != str(self.size):
+                    raise IOError(f'Remote size has changed: {total} != {self.size}')
+                data = r.content
+            else:
+                # the server ignores the Range header: skip to the start
+                logging.getLogger().warning(f'Range request is not honoured: {self.url}')
+                data = bytearray()
+                for chunk in r.iter_content(chunk_size=self.blocksize):
+                    data += chunk
+                    if len(data) > end:
+                        break
+                data = bytes(data[start:end + 1])
+            if self.etag is None:
+                self.etag = r.headers.get('ETag')
+        if len(data) != end + 1 - start:
+            raise IOError(f'Incomplete transfer of bytes {start}-{end} of {self.url}')
+        blocks = {}
+        for i in range(first, last + 1):
+            offset = (i - first) * self.blocksize
+            blocks[i] = data[offset:offset + self.blocksize]
+            self.store(i, blocks[i])
+            if self.disk is not None:
+                self.disk.put(i, blocks[i])
+        return blocks
+
+    def fetch_pending(self, first, last):
         try:
-            if self.iterator is None:
-                self.reset()
-            self.last_offset += len(self.last_page)
-            self.last_page = next(self.iterator)
-            return self.last_page
-
-        except StopIteration:
-            return bytearray()
+            return self.fetch(first, last)
+        finally:
+            with self.lock:
+                for i in range(first, last + 1):
+                    self.pending.pop(i, None)
+
+    def prefetch(self, start, stop):
+        """Fetch the blocks of the bytes start to stop in the background."""
+        if self.executor is None or self.content is not None:
+            return
+        stop = min(stop, self.size)
+        if start >= stop:
+            return
+        first, last = start // self.blocksize, (stop - 1) // self.blocksize
+        with self.lock:
+            wanted = [i for i in range(first, last + 1)
+                      if i not in self.blocks and i not in self.pending
+                      and (self.disk is None or i not in self.disk)]
+            for run in runs(wanted, self.request_blocks):
+                future = self.executor.submit(self.fetch_pending, run[0], run[-1])
+                for i in run:
+                    self.pending[i] = future
+
+    def block(self, index):
+        """Return a block from memory, from a background request or from disk, or None."""
+        with self.lock:
+            block = self.blocks.get(index)
+            if block is not None:
+                self.blocks.move_to_end(index)
+                return block
+            future = self.pending.get(index)
+        if future is not None:
+            try:
+                block = future.result().get(index)
+            except Exception:
+                # a failed prefetch is retried by the read itself
+                block = None
+            if block is not None:
+                return block
+        if self.disk is not None:
+            block = self.disk.get(index)
+            if block is not None:
+                self.store(index, block)
+        return block
 
     def __getitem__(self, domain):
         if self.content is not None:
             return self.content[domain]
 
-        if domain.start > domain.stop:
+        start, stop = domain.start, min(domain.stop, self.size)
+        if start >= stop:
             return bytes()
 
-        response = bytes()
-
-        if self.last_offset > domain.start:
-            self.reset()
-
-        if self.last_offset <= domain.start + len(self.last_page):
-            while self.last_offset + len(self.last_page) <= domain.start:
-                chunk = self.read_next()
-                if len(chunk) == 0:
-                    break
-
-            L = self.last_offset + len(self.last_page)
-            end = max(min(domain.stop, L) - self.last_offset, 0)
-
-            if end <= 0:
-                return bytes()
-
-            start = domain.start - self.last_offset
-            response = response + self.last_page[start:end]
-
-            N = max(end - start, 0)
-
-            if domain.start + N < domain.stop:
-                response = response + self[domain.start + N:domain.stop]
-        return response
+        first, last = start // self.blocksize, (stop - 1) // self.blocksize
+        blocks = {}
+        missing = []
+        for i in range(first, last + 1):
+            block = self.block(i)
+            if block is not None:
+                blocks[i] = block
+            else:
+                missing.append(i)
+        # one request for every run of consecutive missing blocks
+        for run in runs(missing):
+            blocks.update(self.fetch(run[0], run[-1]))
+
+        data = b''.join(blocks[i] for i in range(first, last + 1))
+        offset = first * self.blocksize
+        return data[start - offset:stop - offset]
+
+
+class ReadAhead:
+    """Sequential read detection and readahead for one open file handle.
+
+    Every read which starts where the previous one ended doubles the
+    readahead window, from one block up to max_window bytes (at most half
+    of the memory cache of the file); any other read closes it again. The
+    next part of the window is prefetched once less than half of it is
+    left ahead of the reads.
+    """
+
+    def __init__(self, webfile, max_window):
+        self.webfile = webfile
+        self.max_window = min(max_window, webfile.max_blocks * webfile.blocksize // 2)
+        self.window = 0
+        self.next = 0
+        self.ahead = 0
+
+    def read(self, offset, size):
+        wf = self.webfile
+        if offset == self.next and self.max_window > 0:
+            self.window = min(max(2 * self.window, wf.blocksize), self.max_window)
+        else:
+            self.window = 0
+        self.next = offset + size
+        if self.window and self.ahead - self.next < self.window // 2:
+            wf.prefetch(max(self.ahead, self.next), self.next + self.window)
+            self.ahead = self.next + self.window
+        return wf[offset:offset + size]
 
 
 class ZenodoFS(LoggingMixIn, Operations):
 
-    def __init__(self, recordIDs, sandbox_recordIDs, chunksize=64, largefile=1024):
+    def __init__(self, recordIDs, sandbox_recordIDs, chunksize=64, largefile=1024,
+                 cachedir=None, metadata_ttl=600, cache_size=64, disk_quota=1024, readahead=8,
+                 readahead_jobs=4):
         self.records = {'sandbox': [],
                         'zenodo': [],
                         }
         self.attr_cache = SBox(default_box=True)
         self.dir_cache = SBox(default_box=True)
         self.open_files = {}
+        self.open_count = Counter()
+        self.handles = {}
+        self.last_fh = 0
         self.content = {}
         self.chunksize = chunksize
         self.largefile = largefile
+        self.cache_size = cache_size
+        self.readahead = readahead * 2**20
+        self.executor = ThreadPoolExecutor(readahead_jobs) if readahead > 0 else None
         self.logger = logging.getLogger()
+        self.session = requests.Session()
+        self.metadata_cache = MetadataCache(cachedir or cache_dir(), metadata_ttl)
+        self.block_cache = None
+        if disk_quota > 0:
+            self.block_cache = BlockCache(cachedir or cache_dir(), disk_quota * 2**20, chunksize * 1024)
         for rid in recordIDs:
             self.get_metadata(rid, sandbox=False)
         for rid in sandbox_recordIDs:
@@ -114,7 +269,7 @@ class ZenodoFS(LoggingMixIn, Operations):
             url = 'https://sandbox.zenodo.org/api/records/'
 
         try:
-            r = requests.get(url + recordID, timeout=timeout)
+            record = self.metadata_cache.get(self.session, url + recordID, timeout=timeout)
         except requests.exceptions.ConnectTimeout:
             self.logger.critical('Connection timeout during metadata reading.')
             raise
@@ -123,9 +278,9 @@ class ZenodoFS(LoggingMixIn, Operations):
             raise
 
         js = {}
-        if r.ok:
-            js = json.loads(r.text)['files']
-            for f in json.loads(r.text)['files']:
+        if record is not None:
+            js = record['files']
+            for f in record['files']:
                 path = 'zenodo' if not sandbox else 'sandbox'
                 self.attr_cache[f'/{path}/{recordID}/{f["key"]}'] = SBox(
                     f, default_box=True)
@@ -190,20 +345,39 @@ class ZenodoFS(LoggingMixIn, Operations):
         if path not in self.open_files:
             url = self.attr_cache[path]['links'].get('self')
             size = self.attr_cache[path].get('size', 0)
-            self.open_files[path] = WebFile(url, size, self.chunksize, self.largefile)
-        return 0
+            checksum = self.attr_cache[path].get('checksum')
+            disk = None
+            if self.block_cache is not None and checksum:
+                parts = path.split('/')
+                disk = self.block_cache.open(f'{parts[1]}-{parts[2]}', checksum, size)
+            self.open_files[path] = WebFile(url, size, self.chunksize, self.largefile,
+                                            session=self.session, cache_size=self.cache_size, disk=disk,
+                                            executor=self.executor)
+        self.open_count[path] += 1
+        self.last_fh += 1
+        self.handles[self.last_fh] = ReadAhead(self.open_files[path], self.readahead)
+        return self.last_fh
 
     def read(self, path, size, offset, fh):
         if path in self.content:
             return self.content[path][offset:offset + size]
 
+        if fh in self.handles:
+            return self.handles[fh].read(offset, size)
         return self.open_files[path][offset:offset + size]
 
     def release(self, path, fh):
-        if path in self.open_files:
+        self.handles.pop(fh, None)
+        self.open_count[path] -= 1
+        if self.open_count[path] <= 0 and path in self.open_files:
+            del self.open_count[path]
             wf = self.open_files.pop(path)
             wf.close()
 
+    def destroy(self, path):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
 
 if __name__ == '__main__':
 
@@ -215,9 +389,20 @@ if __name__ == '__main__':
     parser.add_argument("-s", "--sandbox", nargs='+', action='extend', default=[],
                         help='sandbox record ID(s)')
     parser.add_argument("-c", "--chunk_size", type=int, default=64,
-                        help='chunk size [KB] for network download (default: 64)')
+                        help='block size [KB] of the Range requests (default: 64)')
+    parser.add_argument("-m", "--memory_cache", type=int, default=64,
+                        help='size [MB] of the block cache of each open file (default: 64)')
     parser.add_argument("-l", "--large_file_limit", type=int, default=256,
                         help='file size [KB] which is downloaded without splitting into chunks (default: 256)')
+    parser.add_argument("-a", "--readahead", type=int, default=8,
+                        help='maximum readahead [MB] of sequential reads; 0 disables it (default: 8)')
+    parser.add_argument("-C", "--cache_dir", type=str, default=cache_dir(),
+                        help=f'directory for cached metadata and blocks (default: {cache_dir()})')
+    parser.add_argument("-Q", "--disk_cache", type=int, default=1024,
+                        help='size [MB] of the block cache on disk, shared by all files and '
+                             'kept across mounts; 0 disables it (default: 1024)')
+    parser.add_argument("-t", "--metadata_ttl", type=float, default=600,
+                        help='seconds before cached metadata is revalidated (default: 600)')
 
     parser.add_argument("-L", "--log_level",
                         default='error',
@@ -240,7 +425,10 @@ if __name__ == '__main__':
 
     logging.basicConfig(level=level)
 
-    fuse = FUSE(ZenodoFS(args.record, args.sandbox, chunksize=args.chunk_size, largefile=args.large_file_limit),
+    fuse = FUSE(ZenodoFS(args.record, args.sandbox, chunksize=args.chunk_size, largefile=args.large_file_limit,
+                         cachedir=args.cache_dir, metadata_ttl=args.metadata_ttl,
+                         cache_size=args.memory_cache, disk_quota=args.disk_cache,
+                         readahead=args.readahead),
                 args.mountpoint,
                 foreground=args.foreground,
                 nothreads=True,